@@ -1,7 +1,8 @@
 from enum import Enum,IntEnum
-from functools import reduce
+from functools import reduce, lru_cache
 from datetime import datetime
 from pyDatalog import pyDatalog
+import gc
 import os
 
 pyDatalog.create_terms("""
@@ -22,6 +23,25 @@ pyDatalog.create_terms("X,Y,Z")
 def age_as_of(dob,date_as_of):
   return date_as_of.year - dob.year - ((date_as_of.month, date_as_of.day) < (dob.month, dob.day))
 
+# DATE_ASOF in the CMS software: February 1 of the payment year
+def payment_year_as_of(year):
+  return datetime(year,2,1)
+
+# dates of birth repeat across a population, so each is parsed once
+@lru_cache(maxsize=65536)
+def parse_dob(dob):
+  if len(dob) == 8 and dob.isdigit():
+    return datetime(int(dob[:4]),int(dob[4:6]),int(dob[6:]))
+  return datetime.strptime(dob,"%Y%m%d")
+
+#    DISABL = (&AGEF < 65 & &OREC ne "0");
+def is_disabled(age,orec):
+  return age < 65 and orec != EntitlementReason.OASI
+
+#    ORIGDS  = (&OREC = '1')*(DISABL = 0);
+def is_originally_disabled(age,orec):
+  return orec == EntitlementReason.DIB and not is_disabled(age,orec)
+
 class EntitlementReason(IntEnum):
   OASI=0
   DIB=1
@@ -32,6 +52,51 @@ class ICDType(IntEnum):
   NINE = 9
   TEN = 0
 
+class Engine(Enum):
+  DATALOG = "datalog"
+  COMPILED = "compiled"
+
+# Beneficiary and Diagnosis instances are facts for as long as they are
+# registered with pyDatalog.Mixin.  A Session scopes the instances created
+# inside it to one scoring batch and retracts them when the batch ends, so
+# the knowledge base queries scan stays the size of one batch.
+_sessions = []
+
+def track(obj):
+  if _sessions:
+    _sessions[-1].members.append(obj)
+
+def retract(obj):
+  for cls in type(obj).__mro__:
+    refs = pyDatalog.metaMixin.__refs__.get(cls)
+    if refs is not None:
+      refs.discard(obj)
+
+class Session:
+  def __init__(self):
+    self.members = []
+
+  def __enter__(self):
+    _sessions.append(self)
+    return self
+
+  def __exit__(self, *exc):
+    _sessions.remove(self)
+    self.close()
+
+  def close(self):
+    for obj in self.members:
+      retract(obj)
+    self.members = []
+
+def session():
+  return Session()
+
+# codes are matched against icd10.txt/icd9.txt as written there: no dots,
+# upper case, no surrounding whitespace ("e11.9 " -> "E119")
+def normalize_icd(code):
+  return code.strip().replace(".","").upper()
+
 class Diagnosis(pyDatalog.Mixin):
   def __init__(self,
               beneficiary,
@@ -39,8 +104,9 @@ class Diagnosis(pyDatalog.Mixin):
               codetype=ICDType.NINE):
     super().__init__()
     self.beneficiary = beneficiary
-    self.icdcode = icdcode
+    self.icdcode = normalize_icd(icdcode)
     self.codetype = codetype
+    track(self)
 
   def __repr__(self): # specifies how to display an Employee
     return str(self.beneficiary) + str(self.icdcode) + str(self.codetype)
@@ -50,16 +116,23 @@ class Beneficiary(pyDatalog.Mixin):
               hicno,sex,dob,
               original_reason_entitlement=EntitlementReason.OASI,
               medicaid=False,
-              newenrollee_medicaid=False,):
+              newenrollee_medicaid=False,
+              as_of=None):
     super().__init__()
     self.hicno = hicno
     self.sex = sex
-    self.dob = datetime.strptime(dob,"%Y%m%d")
-    self.age = age_as_of(self.dob,datetime.now())
+    self.dob = parse_dob(dob)
+    # pass as_of (e.g. payment_year_as_of(2017)) for scores that do not
+    # depend on the day the job runs
+    self.as_of = as_of or datetime.now()
+    self.age = age_as_of(self.dob,self.as_of)
     self.medicaid = medicaid
     self.newenrollee_medicaid = newenrollee_medicaid
     self.original_reason_entitlement = original_reason_entitlement
+    self.disabled = is_disabled(self.age,original_reason_entitlement)
+    self.originally_disabled = is_originally_disabled(self.age,original_reason_entitlement)
     self.diagnoses = []
+    track(self)
 
   def __repr__(self): # specifies how to display an Employee
     return "ID:" + str(self.hicno) + ",DOB:" + str(self.dob)
@@ -67,9 +140,12 @@ class Beneficiary(pyDatalog.Mixin):
   def add_diagnosis(self,diag):
     self.diagnoses.append(diag)
 
+  def remove_diagnosis(self,diag):
+    self.diagnoses.remove(diag)
+
 # lines 352 - 361
-def load_diagnostic_category_facts():
-  diagnostic_categories = [
+def diagnostic_categories():
+  return [
           ("cancer",["8","9","10","11","12"]),
           ("diabetes",["17","18","19"]),
           ("immune",["47"]),
@@ -80,32 +156,45 @@ def load_diagnostic_category_facts():
           ("compl",["176"]),
           ("pressure_ulcer",["157","158","159","160"]),
           ("sepsis",["2"]) ]
-  for dcE, ccs in diagnostic_categories:
+
+def load_diagnostic_category_facts():
+  for dcE, ccs in diagnostic_categories():
     for ccE in ccs:
       + dc(dcE,ccE)
 
-def load_coefficients(f):
+def read_coefficients(f):
   dir = os.path.dirname(__file__)
-  file = open(os.path.join(dir,f), 'r')                                     
-  for line in file:
-    vals = list(map(lambda s: s.strip(),line.split(",")))
-    label,coeff = vals
-    + coefficient(label,float(coeff)) 
+  with open(os.path.join(dir,f), 'r') as file:
+    for line in file:
+      vals = list(map(lambda s: s.strip(),line.split(",")))
+      if len(vals) == 2:
+        label,coeff = vals
+        yield label,float(coeff)
+
+def load_coefficients(f,coefficients=None):
+  for label,coeff in (coefficients if coefficients is not None else read_coefficients(f)):
+    + coefficient(label,coeff) 
   + coefficient('starting',0.00)
 
-def load_cc_facts(f,icdcodetype):
+def read_cc_file(f):
   dir = os.path.dirname(__file__)
-  file = open(os.path.join(dir,f), 'r')                                     
-  for line in file:
-    vals = line.split()
-    if len(vals) == 2:
-      icdE,ccE = vals
-    elif len(vals) == 3:
-      icdE,ccE,_ = vals
+  with open(os.path.join(dir,f), 'r') as file:
+    for line in file:
+      vals = line.split()
+      if len(vals) == 2:
+        icdE,ccE = vals
+      elif len(vals) == 3:
+        icdE,ccE,_ = vals
+      else:
+        continue
+      yield icdE,ccE
+
+def load_cc_facts(f,icdcodetype,pairs=None):
+  for icdE,ccE in (pairs if pairs is not None else read_cc_file(f)):
     + cc(icdE,ccE,icdcodetype) 
 
-def load_hcc_facts():
-  overriders = [
+def hierarchy():
+  return [
           ("8",["9","10","11","12" ]),
           ("9",["10","11","12" ]),
           ("10",["11","12" ]),
@@ -145,17 +234,24 @@ def load_hcc_facts():
           ("160",["161" ]),
           ("166",["80","167" ])
           ]
-  for overrider, overridees in overriders:
+
+def load_hcc_facts():
+  for overrider, overridees in hierarchy():
     for overridee in overridees:
       + overrides(overrider,overridee)
 
+def code_tables():
+  return [("icd10.txt",0), ("icd9.txt",9)]
+
 def load_facts():
-  
-  load_cc_facts("icd10.txt",0)
-  load_cc_facts("icd9.txt",9)
+  # parsed tables come from the binary cache in hcc_tables when it is current
+  import hcc_tables
+  parsed = hcc_tables.parsed_tables()
+  for f,icdcodetype in code_tables():
+    load_cc_facts(f,icdcodetype,parsed.cc[icdcodetype])
   load_hcc_facts()
   load_diagnostic_category_facts()
-  load_coefficients("coefficients.txt")
+  load_coefficients(hcc_tables.coefficient_file,parsed.coefficients)
   
 def community_regression():
   # &COMM_REG
@@ -222,6 +318,35 @@ def institutional_regression():
               "HCC169","HCC170","HCC173","HCC176","HCC186","HCC188","HCC189" ]
   return reg_vars 
 
+def hccees():
+  return [ 
+        '100', '103', '104', '106', '107', '108', '10', '110', '111', '112', '114', '115', 
+        '11', '122', '124', '12', '134', '135', '136', '137', '138', '139', '140', '141', 
+        '157', '158', '159', '160', '161', '162', '166', '167', '169', '170', '173', '176', 
+        '17', '186', '188', '189', '18', '19', '1', '21', '22', '23', '27', '28', '29', '2', 
+        '33', '34', '35', '39', '40', '46', '47', '48', '51', '52', '54', '55', '57', '58', 
+        '6', '70', '71', '72', '73', '74', '75', '76', '77', '78', '79', '80', '82', '83', 
+        '84', '85', '86', '87', '88', '8', '96', '99', '9']
+
+# (icd type, cc, icds) applied when the beneficiary is female
+def sex_edits():
+  return [(9,"48",["2860", "2861"]),
+          (0,"48",["D66", "D67"])]
+
+# (icd type, cc, icds) applied when the beneficiary is under 18
+def age_edits():
+  return [(9,"112",["4910", "4911", "49120", "49121", "49122",
+                    "4918", "4919", "4920",  "4928",  "496",  
+                    "5181", "5182"]),
+          (0,"112",["J410", 
+                    "J411", "J418", "J42",  "J430",
+                    "J431", "J432", "J438", "J439", "J440",
+                    "J441", "J449", "J982", "J983"])]
+
+# (icd type, icds) dropped when the beneficiary is under 18
+def age_excisions():
+  return [(9,["49320", "49321", "49322"])]
+
 def load_rules():
   Ben = Beneficiary
   Diag = Diagnosis
@@ -240,20 +365,15 @@ def load_rules():
   #    ORIGDS  = (&OREC = '1')*(DISABL = 0);
   originally_disabled(B) <= (Ben.original_reason_entitlement[B] == EntitlementReason.DIB) & ~(disabled(B))
 
-  edit(ICD,9,B,"48")  <= female(B) & (ICD.in_(["2860", "2861"]))
-  edit(ICD,9,B,"112") <= age(B,A)  & (A < 18) & \
-                              (ICD.in_(["4910", "4911", "49120", "49121", "49122",
-                                        "4918", "4919", "4920",  "4928",  "496",  
-                                        "5181", "5182"]))
-  edit(ICD,0,B,"48")  <= female(B) & (ICD.in_(["D66", "D67"]))
-  edit(ICD,0,B,"112") <= age(B,A)  & (A < 18) & (ICD.in_(["J410", 
-                                 "J411", "J418", "J42",  "J430",
-                                 "J431", "J432", "J438", "J439", "J440",
-                                 "J441", "J449", "J982", "J983"]))
+  for icdtype,ccE,icds in sex_edits():
+    edit(ICD,icdtype,B,ccE)  <= female(B) & (ICD.in_(icds))
+  for icdtype,ccE,icds in age_edits():
+    edit(ICD,icdtype,B,ccE) <= age(B,A)  & (A < 18) & (ICD.in_(icds))
 
   #IF &AGE < 18 AND &ICD9 IN ("49320", "49321", "49322") 
   #                                           THEN CC="-1.0";
-  excised(ICD,9,B) <= age(B,A)  & (A < 18) & (ICD.in_(["49320", "49321", "49322"]))
+  for icdtype,icds in age_excisions():
+    excised(ICD,icdtype,B) <= age(B,A)  & (A < 18) & (ICD.in_(icds))
 
   beneficiary_icd(B,ICD,Type) <= (Diag.beneficiary[D] == B) & (Diag.icdcode[D]==ICD) & (Diag.codetype[D]==Type) 
   beneficiary_has_cc(B,CC) <= beneficiary_icd(B,ICD,Type)  & edit(ICD,Type,B,CC) & ~(excised(ICD,Type,B))
@@ -325,15 +445,7 @@ def load_rules():
   indicator(B,'F85_89') <=  sex_age_range('female',B,85,89)
   indicator(B,'F90_94') <=  sex_age_range('female',B,90,94)
   indicator(B,'F95_GT') <=  sex_age_range('female',B,95,-1.0)
-  hccees = [ 
-        '100', '103', '104', '106', '107', '108', '10', '110', '111', '112', '114', '115', 
-        '11', '122', '124', '12', '134', '135', '136', '137', '138', '139', '140', '141', 
-        '157', '158', '159', '160', '161', '162', '166', '167', '169', '170', '173', '176', 
-        '17', '186', '188', '189', '18', '19', '1', '21', '22', '23', '27', '28', '29', '2', 
-        '33', '34', '35', '39', '40', '46', '47', '48', '51', '52', '54', '55', '57', '58', 
-        '6', '70', '71', '72', '73', '74', '75', '76', '77', '78', '79', '80', '82', '83', 
-        '84', '85', '86', '87', '88', '8', '96', '99', '9']
-  for i in hccees:
+  for i in hccees():
     indicator(B,'HCC' + i ) <=  ben_hcc(B,i) 
   indicator(B,'M0_34') <=  sex_age_range('male',B,0,34)
   indicator(B,'M35_44') <=  sex_age_range('male',B,35,44)
@@ -440,11 +552,11 @@ def load_rules():
   (valid_institutional_variables[B] == concat_(CC,key=CC,sep=',')) <= indicator(B,CC) & CC.in_(ivars)
   (valid_new_enrollee_variables[B] == concat_(CC,key=CC,sep=',')) <= indicator(B,CC) & CC.in_(nevars)
 
-  (new_enrollee_score[B] == sum_(Coef,key=Coef)) <=  indicator(B,CC) \
+  (new_enrollee_score[B] == sum_(Coef,for_each=CC)) <=  indicator(B,CC) \
                                                 & CC.in_(nevars) & coefficient("NE_"+CC,Coef)
-  (institutional_score[B] == sum_(Coef,key=Coef)) <=  indicator(B,CC) \
+  (institutional_score[B] == sum_(Coef,for_each=CC)) <=  indicator(B,CC) \
                                                 & CC.in_(ivars) & coefficient("INS_"+CC,Coef)
-  (community_score[B] == sum_(Coef,key=Coef)) <=  indicator(B,CC) \
+  (community_score[B] == sum_(Coef,for_each=CC)) <=  indicator(B,CC) \
                                                 & CC.in_(cvars) & coefficient("CE_"+CC,Coef)
 
   score(B,"community",Score) <= (community_score[B] == Score)
@@ -457,9 +569,80 @@ def load_rules():
   output(B,"age",Val) <= age(B,Val)
   
 
-load_facts()
-load_rules()
-
+# facts and rules are loaded on first use rather than on import; call load()
+# before querying the Datalog terms (score, output, ...) directly.
+# pyDatalog runs gc.collect() before queries on Mixin classes; a process
+# that owns its heap (a worker, a CLI) can pass freeze_gc=True to move
+# everything allocated so far, the facts and rules included, out of those
+# collections so they cost one batch, not the whole knowledge base.  It is
+# off by default: gc.freeze() applies to the whole interpreter, and objects
+# frozen with the rules are never collected.
+_loaded = False
+
+def load(freeze_gc=False):
+  global _loaded
+  if not _loaded:
+    load_facts()
+    load_rules()
+    _loaded = True
+    if freeze_gc:
+      gc.freeze()
+
+# score one beneficiary for one model ("community", "institutional" or
+# "new_enrollee") with either engine; the scores agree to within 1e-6
+# (see hcc_check.py)
+# the pyDatalog rules above are the default model version only; other
+# registered versions (see hcc_models) run on the compiled engine
+def datalog_version(version):
+  import hcc_models
+  if version is not None and version != hcc_models.default_name:
+    raise ValueError("model version %s needs Engine.COMPILED; the Datalog rules implement %s"
+                     % (version, hcc_models.default_name))
+
+def compute_score(b,model,engine=Engine.DATALOG,version=None):
+  if Engine(engine) == Engine.COMPILED:
+    import hcc_engine
+    return hcc_engine.score(b,model,hcc_engine.tables(version))
+  datalog_version(version)
+  load()
+  answer = score(b,model,Score)
+  return answer.data[0][0] if answer.data else 0.0
+
+# models= of compute_scores as a list, checked against the version's
+# regressions so both engines reject the same requests
+def scored_models(models,version=None):
+  import hcc_models
+  if models is None:
+    return None
+  if isinstance(models,str):
+    raise TypeError("models must be a list of model names, not the string %r" % models)
+  models = list(models)
+  known = hcc_models.get(version).regressions
+  unknown = [m for m in models if m not in known]
+  if unknown:
+    raise ValueError("unknown models %s (the models are %s)" % (", ".join(map(str,unknown)), ", ".join(known)))
+  return models
+
+# every model's score and valid_*_variables string for one beneficiary, or
+# for the given models only; the compiled engine derives all of them from a
+# single indicator set, evaluating only what those models read
+def compute_scores(b,engine=Engine.DATALOG,version=None,models=None):
+  models = scored_models(models,version)
+  if Engine(engine) == Engine.COMPILED:
+    import hcc_engine
+    return hcc_engine.score_all(b,hcc_engine.tables(version),models=models)
+  datalog_version(version)
+  load()
+  out = {}
+  for model, variables in (("community",valid_community_variables),
+                           ("institutional",valid_institutional_variables),
+                           ("new_enrollee",valid_new_enrollee_variables)):
+    if models is not None and model not in models:
+      continue
+    out[model] = compute_score(b,model)
+    answer = (variables[b] == Val)
+    out["valid_%s_variables" % model] = answer.data[0][0] if answer.data else ""
+  return out
 
 ####################################################
 jane = Beneficiary(2,"female","19740824",EntitlementReason.DIB,True)
@@ -0,0 +1,331 @@
+import numpy as np
+import hcc_engine
+import hcc_icd
+import hcc_models
+import hcc_profile
+from hcc import EntitlementReason
+
+# Batch scoring of a whole population with numpy.  Members become rows of a
+# member x CC matrix, the hierarchy and the interactions are column
+# operations on it, and each model is a matrix-vector product of the
+# member x variable indicator matrix against that model's coefficients.
+
+models = ["community", "institutional", "new_enrollee"]
+
+class BatchTables:
+  def __init__(self, t=None):
+    t = t or hcc_engine.tables()
+    self.engine_tables = t
+    self.name = t.name
+    self.mapping_key = t.mapping_key
+
+    ccs = set(t.hccees)
+    for mapped in list(t.cc.values()) + list(t.sex_edits.values()) + list(t.age_edits.values()):
+      ccs |= mapped
+    for overrider, overridees in t.overrides.items():
+      ccs.add(overrider)
+      ccs |= overridees
+    self.ccs = sorted(ccs, key=lambda c: (len(c),c))
+    self.cc_index = {c:i for i,c in enumerate(self.ccs)}
+    ncc = len(self.ccs)
+
+    # (icd,type) -> row of the key tables, padded with -1; the rows are the
+    # code ids of the version's hcc_icd index
+    self.icd = hcc_icd.ICDIndex(t)
+    self.keys = self.icd.codes
+    self.key_index = {k:i for i,k in enumerate(self.keys)}
+    def padded(table):
+      width = max([len(v) for v in table.values()] + [1])
+      out = np.full((len(self.keys),width),-1,dtype=np.int32)
+      for k, mapped in table.items():
+        out[self.key_index[k],:len(mapped)] = sorted(self.cc_index[c] for c in mapped)
+      return out
+    self.key_cc = padded(t.cc)
+    self.key_sex_cc = padded(t.sex_edits)
+    self.key_age_cc = padded(t.age_edits)
+    self.key_excised = np.zeros(len(self.keys),dtype=bool)
+    for k in t.age_excisions:
+      self.key_excised[self.key_index[k]] = True
+
+    # overrides(OT,CC) as a cc x cc matrix
+    self.overrides = np.zeros((ncc,ncc),dtype=np.float32)
+    for overrider, overridees in t.overrides.items():
+      for overridee in overridees:
+        self.overrides[self.cc_index[overrider],self.cc_index[overridee]] = 1
+
+    allvars = set().union(*[reg_vars for reg_vars,_ in t.models.values()])
+    self.variables = sorted(allvars)
+    self.var_index = {v:i for i,v in enumerate(self.variables)}
+
+    def columns(names):
+      return np.array([self.var_index[n] for n in names],dtype=np.intp)
+    hcc_vars = [c for c in sorted(t.hccees) if 'HCC' + c in self.var_index]
+    self.hcc_var_cols = columns(['HCC' + c for c in hcc_vars])
+    self.hcc_cc_cols = np.array([self.cc_index[c] for c in hcc_vars],dtype=np.intp)
+
+    interactions = [i for i in t.interactions if i[0] in self.var_index]
+    self.interaction_cols = columns([name for name,_,_ in interactions])
+    self.interaction_left = np.zeros((ncc,len(interactions)),dtype=np.float32)
+    self.interaction_right = np.zeros((ncc,len(interactions)),dtype=np.float32)
+    for j, (_, left, right) in enumerate(interactions):
+      for c in left & set(self.cc_index):
+        self.interaction_left[self.cc_index[c],j] = 1
+      for c in right & set(self.cc_index):
+        self.interaction_right[self.cc_index[c],j] = 1
+
+    disabled = [(n,c) for n,c in t.disabled_interactions if n in self.var_index]
+    self.disabled_cols = columns([n for n,_ in disabled])
+    self.disabled_cc_cols = np.array([self.cc_index[c] for _,c in disabled],dtype=np.intp)
+    # dc(CC,'pressure_ulcer'), argument order as in load_rules
+    self.disabled_pressure_ulcer = np.array(
+      ['pressure_ulcer' in t.dc.get(c,()) for c in self.ccs],dtype=bool)
+    self.pressure_ulcer_col = self.var_index.get('DISABLED_PRESSURE_ULCER')
+
+    # CE_*, INS_* and NE_* coefficient vectors over self.variables
+    self.coefficients = {}
+    for model, (reg_vars, prefix) in t.models.items():
+      coef = np.zeros(len(self.variables))
+      for v in reg_vars:
+        coef[self.var_index[v]] = t.coefficients.get(prefix + v,0.0)
+      self.coefficients[model] = coef
+    self.plans = {}
+
+  # the BatchPlan for a set of models (all of them when models is None)
+  def plan(self, models=None):
+    key = tuple(sorted(models)) if models is not None else None
+    if key not in self.plans:
+      self.plans[key] = BatchPlan(self, key)
+    return self.plans[key]
+
+# hcc_engine.Plan as column selections of the batch tables: the HCC,
+# interaction and disabled columns some planned model reads, and whether the
+# cc matrix is needed at all
+class BatchPlan:
+  def __init__(self, bt, models=None):
+    p = bt.engine_tables.plan(models)
+    self.models = p.models
+    self.diagnoses = p.diagnoses
+    def used(cols):
+      return np.array([j for j,c in enumerate(cols) if bt.variables[c] in p.variables],dtype=np.intp)
+    hcc = used(bt.hcc_var_cols)
+    self.hcc_var_cols, self.hcc_cc_cols = bt.hcc_var_cols[hcc], bt.hcc_cc_cols[hcc]
+    interactions = used(bt.interaction_cols)
+    self.interaction_cols = bt.interaction_cols[interactions]
+    self.interaction_left = bt.interaction_left[:,interactions]
+    self.interaction_right = bt.interaction_right[:,interactions]
+    disabled = used(bt.disabled_cols)
+    self.disabled_cols, self.disabled_cc_cols = bt.disabled_cols[disabled], bt.disabled_cc_cols[disabled]
+    self.disabled_pressure_ulcer = bt.disabled_pressure_ulcer
+    self.pressure_ulcer_col = bt.pressure_ulcer_col \
+      if 'DISABLED_PRESSURE_ULCER' in p.variables else None
+
+  def __repr__(self):
+    return "BatchPlan(%s, diagnoses=%s, interactions=%d)" % (
+      ",".join(self.models), self.diagnoses, len(self.interaction_cols))
+
+_batch_tables = {}
+
+def batch_tables(name=None):
+  name = name or hcc_models.default_name
+  if name not in _batch_tables:
+    _batch_tables[name] = BatchTables(hcc_engine.tables(name))
+  return _batch_tables[name]
+
+class BatchResult:
+  def __init__(self, hicnos, variables, indicators, scores, sex=None, age=None,
+               orec=None, medicaid=None, version=None):
+    self.hicnos = hicnos
+    self.variables = variables
+    self.indicators = indicators  # member x variable, uint8
+    self.scores = scores          # model -> float array, one score per member
+    self.sex = sex                # 1 male, 2 female
+    self.age = age
+    self.orec = orec
+    self.medicaid = medicaid
+    self.version = version        # name of the model version it was scored under
+
+  def __len__(self):
+    return len(self.hicnos)
+
+  def __repr__(self):
+    return "BatchResult(members=%d)" % len(self)
+
+def cc_matrix(female, under18, diag_member, diag_key, bt):
+  n = len(female)
+  known = diag_key >= 0
+  rows, kid = diag_member[known], diag_key[known]
+  sex_cc = np.where(female[rows][:,None], bt.key_sex_cc[kid], -1)
+  age_cc = np.where(under18[rows][:,None], bt.key_age_cc[kid], -1)
+  edited = (sex_cc >= 0).any(axis=1) | (age_cc >= 0).any(axis=1)
+  base_cc = np.where(edited[:,None], -1, bt.key_cc[kid])
+  mapped = np.hstack([sex_cc, age_cc, base_cc])
+  excised = bt.key_excised[kid] & under18[rows]
+  mapped[excised] = -1
+  if hcc_profile.current is not None:
+    hcc_profile.current.count("batch.edited_diagnoses", int(edited.sum()))
+    hcc_profile.current.count("batch.excised_diagnoses", int(excised.sum()))
+  member = np.repeat(rows, mapped.shape[1])
+  mapped = mapped.ravel()
+  ccs = np.zeros((n,len(bt.ccs)),dtype=bool)
+  ccs[member[mapped >= 0], mapped[mapped >= 0]] = True
+  return ccs
+
+def hcc_matrix(ccs, bt):
+  # has_cc_that_overrides_this_one, one product for every pair in the hierarchy
+  overridden = (ccs.astype(np.float32) @ bt.overrides) > 0
+  return ccs & ~overridden
+
+def demographic_matrix(sex, age, orec, medicaid, bt):
+  cells = np.stack([sex, age, orec, medicaid.astype(np.int64)],axis=1)
+  unique, inverse = np.unique(cells,axis=0,return_inverse=True)
+  demo = np.zeros((len(unique),len(bt.variables)),dtype=np.uint8)
+  sexes = {1:"male",2:"female"}
+  for i, (s, a, o, m) in enumerate(unique):
+    for v in hcc_engine.demographic_indicators(sexes.get(s), int(a), int(o), bool(m)):
+      if v in bt.var_index:
+        demo[i,bt.var_index[v]] = 1
+  return demo[inverse.ravel()]
+
+# sex is coded 1 (male) / 2 (female), diag_member holds the member row of
+# every diagnosis and diag_key its row in bt.keys (-1 when unmapped).  Only
+# the given models are scored, and only what they read is evaluated: the
+# new enrollee model alone never builds the cc matrix.
+def score_arrays(sex, age, orec, medicaid, diag_member, diag_key, bt=None, models=None):
+  bt = bt or batch_tables()
+  plan = bt.plan(models)
+  sex = np.asarray(sex,dtype=np.int64)
+  age = np.asarray(age,dtype=np.int64)
+  orec = np.asarray(orec,dtype=np.int64)
+  medicaid = np.asarray(medicaid,dtype=bool)
+  diag_member = np.asarray(diag_member,dtype=np.intp)
+  diag_key = np.asarray(diag_key,dtype=np.intp)
+
+  hccs = None
+  if plan.diagnoses:
+    hccs = hcc_matrix(cc_matrix(sex == 2, age < 18, diag_member, diag_key, bt), bt)
+  ind = indicator_matrix(hccs, sex, age, orec, medicaid, bt, plan)
+  return ind, aggregate(ind, bt, plan.models)
+
+# hccs is None when the plan reads no diagnoses
+def indicator_matrix(hccs, sex, age, orec, medicaid, bt, plan=None):
+  p = plan or bt
+  ind = demographic_matrix(sex, age, orec, medicaid, bt)
+  if hccs is None:
+    return ind
+  dis = (age < 65) & (orec != EntitlementReason.OASI)
+  ind[:,p.hcc_var_cols] |= hccs[:,p.hcc_cc_cols]
+  if len(p.interaction_cols):
+    hf = hccs.astype(np.float32)
+    ind[:,p.interaction_cols] |= ((hf @ p.interaction_left) > 0) & ((hf @ p.interaction_right) > 0)
+  ind[:,p.disabled_cols] |= hccs[:,p.disabled_cc_cols] & dis[:,None]
+  if p.pressure_ulcer_col is not None:
+    ind[:,p.pressure_ulcer_col] |= hccs[:,p.disabled_pressure_ulcer].any(axis=1) & dis
+  return ind
+
+# the sum_ aggregates: one matrix-vector product per model.  einsum rather
+# than a BLAS product, whose tail rows are summed in another order, so a
+# member's score does not depend on the batch it was scored in
+def aggregate(ind, bt, names=None):
+  return {model: np.einsum("ij,j->i", ind, bt.coefficients[model]) for model in names or models}
+
+# the plain tuple a beneficiary is scored from; cheap to pickle to a worker
+def member_record(b):
+  return (b.hicno,
+          1 if b.sex == "male" else 2 if b.sex == "female" else 0,
+          b.age,
+          int(b.original_reason_entitlement),
+          b.medicaid == True,
+          tuple((diag.icdcode,diag.codetype) for diag in b.diagnoses))
+
+# the member columns of a list of member records, with every diagnosis as a
+# (member row, (icd,type)) pair
+def record_arrays(records):
+  sex, age, orec, medicaid = [], [], [], []
+  diag_member, diag_keys = [], []
+  for row, (_, s, a, o, m, diagnoses) in enumerate(records):
+    sex.append(s)
+    age.append(a)
+    orec.append(o)
+    medicaid.append(m)
+    for key in diagnoses:
+      diag_member.append(row)
+      diag_keys.append(key)
+  return sex, age, orec, medicaid, diag_member, diag_keys
+
+def score_records(records, bt=None, models=None):
+  bt = bt or batch_tables()
+  sex, age, orec, medicaid, diag_member, diag_keys = record_arrays(records)
+  diag_key = [bt.key_index.get(key,-1) for key in diag_keys] if bt.plan(models).diagnoses else []
+  ind, scores = score_arrays(sex, age, orec, medicaid, diag_member[:len(diag_key)], diag_key, bt, models)
+  return BatchResult([r[0] for r in records], bt.variables, ind, scores,
+                     np.array(sex,dtype=np.uint8), np.array(age,dtype=np.int16),
+                     np.array(orec,dtype=np.uint8), np.array(medicaid,dtype=bool), bt.name)
+
+# score_records under several registered model versions (all of them when
+# names is None), returning a BatchResult per version.  The member columns
+# are built once, and the cc matrix once per mapping_key; versions sharing
+# it take its columns in their own cc order.
+def score_records_versions(records, names=None):
+  sex, age, orec, medicaid, diag_member, diag_keys = record_arrays(records)
+  hicnos = [r[0] for r in records]
+  sex = np.asarray(sex,dtype=np.int64)
+  age = np.asarray(age,dtype=np.int64)
+  orec = np.asarray(orec,dtype=np.int64)
+  medicaid = np.asarray(medicaid,dtype=bool)
+  diag_member = np.asarray(diag_member,dtype=np.intp)
+  mapped = {}
+  out = {}
+  for name in names or hcc_models.names():
+    bt = batch_tables(name)
+    if bt.mapping_key not in mapped:
+      diag_key = np.array([bt.key_index.get(key,-1) for key in diag_keys],dtype=np.intp)
+      mapped[bt.mapping_key] = (bt, cc_matrix(sex == 2, age < 18, diag_member, diag_key, bt))
+    first, ccs = mapped[bt.mapping_key]
+    if first.ccs != bt.ccs:
+      shared = [i for i,c in enumerate(bt.ccs) if c in first.cc_index]
+      reordered = np.zeros((len(sex),len(bt.ccs)),dtype=bool)
+      reordered[:,shared] = ccs[:,[first.cc_index[bt.ccs[i]] for i in shared]]
+      ccs = reordered
+    ind = indicator_matrix(hcc_matrix(ccs, bt), sex, age, orec, medicaid, bt)
+    out[name] = BatchResult(hicnos, bt.variables, ind, aggregate(ind, bt),
+                            sex.astype(np.uint8), age.astype(np.int16),
+                            orec.astype(np.uint8), medicaid, bt.name)
+  return out
+
+# score every member of an hcc_store.MemberStore, ages taken on as_of
+def score_store(store, bt=None, as_of=None, models=None):
+  bt = bt or batch_tables()
+  age = store.ages(as_of)
+  diag_member = diag_key = np.zeros(0,dtype=np.intp)
+  if bt.plan(models).diagnoses and len(store.diagnoses):
+    code_keys = bt.icd.key_ids(store.codes.keys).astype(np.intp)
+    diag_member, diag_key = store.diagnosis_members(), code_keys[store.diagnoses]
+  ind, scores = score_arrays(store.sex, age, store.orec, store.medicaid,
+                             diag_member, diag_key, bt, models)
+  return BatchResult(list(store.hicnos), bt.variables, ind, scores,
+                     store.sex.astype(np.uint8), age.astype(np.int16),
+                     store.orec.astype(np.uint8), store.medicaid.astype(bool), bt.name)
+
+# score every model (or the given models) for a list of Beneficiary objects
+# in one pass
+def score_population(beneficiaries, bt=None, models=None):
+  return score_records([member_record(b) for b in beneficiaries], bt, models)
+
+# results of the same models, one after the other
+def concat(results, bt=None):
+  bt = bt or batch_tables()
+  if not results:
+    return score_records([], bt)
+  scored = list(results[0].scores)
+  for r in results[1:]:
+    if list(r.scores) != scored:
+      raise ValueError("cannot concatenate results of models %s and %s" % (scored, list(r.scores)))
+    if r.version != results[0].version or r.variables != results[0].variables:
+      raise ValueError("cannot concatenate results of different model versions")
+  return BatchResult([h for r in results for h in r.hicnos], results[0].variables,
+                     np.concatenate([r.indicators for r in results]),
+                     {m: np.concatenate([r.scores[m] for r in results]) for m in scored},
+                     np.concatenate([r.sex for r in results]),
+                     np.concatenate([r.age for r in results]),
+                     np.concatenate([r.orec for r in results]),
+                     np.concatenate([r.medicaid for r in results]), results[0].version)
@@ -0,0 +1,138 @@
+import argparse
+import json
+import os
+import platform
+import resource
+import sys
+import time
+from itertools import islice
+import hcc
+import hcc_batch
+import hcc_engine
+import hcc_synthetic
+import hcc_tables
+from hcc import Engine
+from hcc_profile import percentile
+
+# Throughput benchmark over synthetic populations (see hcc_synthetic.py).
+# For each population size it times
+#   load     parsing the text tables, reading the binary cache, building the
+#            compiled and batch tables and asserting the pyDatalog facts
+#   member   compute_score one member and one model at a time, per engine,
+#            on a sample of the population
+#   batch    hcc_batch.score_records a chunk at a time, every model at once
+# and reports members/sec, p50/p99 latency and peak RSS as JSON:
+#   python hcc_bench.py --sizes 10000 100000 1000000 --out bench.json
+
+models = hcc_batch.models
+
+def peak_rss():
+  rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  return rss if sys.platform == "darwin" else rss * 1024
+
+def timed(fn, *args):
+  start = time.perf_counter()
+  result = fn(*args)
+  return result, time.perf_counter() - start
+
+# latencies are per call (one member, or one chunk for batch); members is
+# how many members those calls scored
+def summary(latencies, members, per="member"):
+  total = sum(latencies)
+  return {"members": members,
+          "calls": len(latencies),
+          "latency_per": per,
+          "seconds": total,
+          "members_per_sec": members / total if total else 0.0,
+          "p50_ms": percentile(latencies, 50) * 1000,
+          "p99_ms": percentile(latencies, 99) * 1000,
+          "peak_rss_bytes": peak_rss()}
+
+def bench_load(datalog=True):
+  version, version_s = timed(hcc_tables.tables_version)
+  parsed, parse_s = timed(hcc_tables.parse_tables, version)
+  path = os.path.join(hcc_tables.cache_dir(), "bench-%d.bin" % os.getpid())
+  out = {"tables_version_s": version_s, "parse_text_s": parse_s}
+  try:
+    os.makedirs(hcc_tables.cache_dir(), exist_ok=True)
+    _, out["write_cache_s"] = timed(hcc_tables.write_cache, parsed, path)
+    _, out["read_cache_s"] = timed(hcc_tables.read_cache, path, version)
+    os.remove(path)
+  except OSError:
+    pass
+  _, out["parsed_tables_s"] = timed(hcc_tables.parsed_tables)
+  _, out["compiled_tables_s"] = timed(hcc_engine.tables)
+  _, out["batch_tables_s"] = timed(hcc_batch.batch_tables)
+  if datalog:
+    _, out["datalog_facts_s"] = timed(hcc.load)
+  out["peak_rss_bytes"] = peak_rss()
+  return out
+
+def bench_member(members, engine, as_of):
+  out = {}
+  with hcc.session():
+    beneficiaries = [hcc_synthetic.beneficiary(m, as_of) for m in members]
+    for model in models:
+      latencies = []
+      for b in beneficiaries:
+        _, elapsed = timed(hcc.compute_score, b, model, engine)
+        latencies.append(elapsed)
+      out[model] = summary(latencies, len(latencies))
+  return out
+
+def bench_batch(records, chunk_size):
+  bt = hcc_batch.batch_tables()
+  latencies = []
+  for start in range(0, len(records), chunk_size):
+    _, elapsed = timed(hcc_batch.score_records, records[start:start + chunk_size], bt)
+    latencies.append(elapsed)
+  return summary(latencies, len(records), "chunk")
+
+def run(sizes, seed=0, sample=10000, datalog_sample=200, chunk_size=10000, as_of=None):
+  as_of = as_of or hcc.payment_year_as_of(2017)
+  report = {"python": platform.python_version(),
+            "platform": platform.platform(),
+            "seed": seed,
+            "as_of": as_of.strftime("%Y-%m-%d"),
+            "chunk_size": chunk_size,
+            "load": bench_load(datalog_sample > 0)}
+  report["tables_version"] = hcc_tables.parsed_tables().version
+  report["populations"] = []
+  for n in sizes:
+    generator = hcc_synthetic.Generator(seed, as_of)
+    records, generate_s = timed(lambda: [hcc_synthetic.member_record(m, as_of)
+                                         for m in generator.members(n)])
+    diagnoses = sum(len(r[5]) for r in records)
+    result = {"size": n, "diagnoses": diagnoses, "generate_s": generate_s,
+              "batch": bench_batch(records, chunk_size), "member": {}}
+    del records
+    for engine, count in ((Engine.COMPILED, sample), (Engine.DATALOG, datalog_sample)):
+      if count > 0:
+        members = list(islice(hcc_synthetic.Generator(seed, as_of).members(n), count))
+        result["member"][engine.value] = bench_member(members, engine, as_of)
+    report["populations"].append(result)
+  return report
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description="Benchmark HCC scoring on synthetic populations.")
+  parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000, 1000000])
+  parser.add_argument("--seed", type=int, default=0)
+  parser.add_argument("--sample", type=int, default=10000,
+                      help="members scored one at a time by the compiled engine")
+  parser.add_argument("--datalog-sample", type=int, default=200,
+                      help="members scored one at a time by pyDatalog (0 to skip)")
+  parser.add_argument("--chunk-size", type=int, default=10000)
+  parser.add_argument("--year", type=int, default=2017, help="payment year the ages are taken in")
+  parser.add_argument("--out", default="-", help="JSON report path, - for stdout")
+  args = parser.parse_args(argv)
+  report = run(args.sizes, args.seed, args.sample, args.datalog_sample, args.chunk_size,
+               hcc.payment_year_as_of(args.year))
+  text = json.dumps(report, indent=1)
+  if args.out == "-":
+    print(text)
+  else:
+    with open(args.out, "w") as f:
+      f.write(text + "\n")
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,105 @@
+import argparse
+import random
+import sys
+import hcc
+import hcc_engine
+from hcc import Beneficiary, Diagnosis, EntitlementReason, Engine, ICDType, X
+
+# Parity of the compiled engine (hcc_engine) with the pyDatalog rules of
+# hcc.load_rules on randomized edge-case members: ages at every age band
+# boundary with birthdays on either side of the as-of date, every OREC,
+# medicaid and new enrollee medicaid, and diagnoses drawn from the sex
+# edits, age edits and age excisions, the codes of the interaction
+# categories and the code table at large.  For each member it compares the
+# indicators, every model's score (within TOLERANCE: pyDatalog's sum_
+# aggregate carries rounding error in the last bits, e.g. 0.8620000034570694
+# for 0.862) and the valid_*_variables strings.  Run it after changing
+# load_rules or hcc_engine:
+#
+#   python hcc_check.py --members 300 --seed 1
+
+TOLERANCE = 1e-6
+
+# the lower and upper ends of the age bands of the demographic variables
+boundaries = [0, 1, 5, 6, 17, 18, 34, 35, 44, 45, 54, 55, 59, 60, 63, 64, 65, 66, 67, 68, 69, 70,
+              74, 75, 79, 80, 84, 85, 89, 90, 94, 95, 100]
+
+class Members:
+  def __init__(self, seed=0, as_of=None, t=None):
+    t = t or hcc_engine.tables()
+    self.random = random.Random(seed)
+    self.as_of = as_of or hcc.payment_year_as_of(2017)
+    self.edits = sorted(set(t.sex_edits) | set(t.age_edits) | t.age_excisions)
+    categories = set()
+    for _, left, right in t.interactions:
+      categories |= set(left) | set(right)
+    categories |= set(cc for _, cc in t.disabled_interactions)
+    self.interaction_codes = sorted(k for k, ccs in t.cc.items() if ccs & categories)
+    self.codes = sorted(t.cc)
+    self.hicno = 0
+
+  def dob(self):
+    r = self.random
+    age = r.choice(boundaries) if r.random() < 0.7 else r.randint(0, 100)
+    # a birthday just before, on or just after the as-of date
+    month, day = r.choice([(self.as_of.month, self.as_of.day), (1, 31), (2, 2), (r.randint(1, 12), r.randint(1, 28))])
+    return "%04d%02d%02d" % (self.as_of.year - age, month, day)
+
+  def member(self):
+    r = self.random
+    self.hicno += 1
+    b = Beneficiary("check-%d" % self.hicno, r.choice(["male", "female"]), self.dob(),
+                    r.choice(list(EntitlementReason)), r.random() < 0.3, r.random() < 0.1, self.as_of)
+    for _ in range(r.randint(0, 12)):
+      source = r.choice([self.edits, self.interaction_codes, self.interaction_codes, self.codes])
+      icd, codetype = r.choice(source)
+      b.add_diagnosis(Diagnosis(b, icd, ICDType(codetype)))
+    return b
+
+# the differences between the engines for one member, as strings
+def compare(b, t=None):
+  t = t or hcc_engine.tables()
+  problems = []
+  datalog = set(row[0] for row in hcc.indicator(b, X).data)
+  compiled = hcc_engine.beneficiary_indicators(b, t)
+  if datalog != compiled:
+    problems.append("indicators: datalog only %s, compiled only %s" %
+                    (sorted(datalog - compiled), sorted(compiled - datalog)))
+  expected = hcc.compute_scores(b)
+  actual = hcc.compute_scores(b, Engine.COMPILED)
+  for key in expected:
+    if key.startswith("valid_"):
+      if set(filter(None, expected[key].split(","))) != set(filter(None, actual[key].split(","))):
+        problems.append("%s: %r != %r" % (key, expected[key], actual[key]))
+    elif abs(expected[key] - actual[key]) > TOLERANCE:
+      problems.append("%s: %r != %r" % (key, expected[key], actual[key]))
+  return problems
+
+def check(members=200, seed=0, out=sys.stdout):
+  hcc.load()
+  t = hcc_engine.tables()
+  generator = Members(seed, t=t)
+  failures = 0
+  for _ in range(members):
+    b = generator.member()
+    problems = compare(b, t)
+    if problems:
+      failures += 1
+      print("%s sex=%s age=%d orec=%s medicaid=%s diagnoses=%s" %
+            (b.hicno, b.sex, b.age, b.original_reason_entitlement.name, b.medicaid,
+             sorted(hcc_engine.diagnosis_keys(b))), file=out)
+      for problem in problems:
+        print("  " + problem, file=out)
+  print("%d of %d members differ" % (failures, members), file=out)
+  return failures
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description="Check the compiled engine against the pyDatalog rules on random members.")
+  parser.add_argument("--members", type=int, default=200)
+  parser.add_argument("--seed", type=int, default=0)
+  args = parser.parse_args(argv)
+  hcc.load(freeze_gc=True)
+  sys.exit(1 if check(args.members, args.seed) else 0)
+
+if __name__ == "__main__":
+  main()
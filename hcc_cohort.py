@@ -0,0 +1,166 @@
+import numpy as np
+import hcc_batch
+import hcc_engine
+from hcc import EntitlementReason
+
+# Cohort statistics over batch scoring output, for population dashboards.
+# Members are grouped by any of their columns in a hcc_batch.BatchResult
+# ("sex", "age_cell", "medicaid", "orec") or by a custom label per member,
+# and every statistic is a numpy reduction over the members sorted by
+# group: mean and percentile scores, the prevalence of each HCC and each
+# HCC's share of the group's total score.
+#
+#   result = hcc_batch.score_store(store, as_of=payment_year_as_of(2017))
+#   c = hcc_cohort.cohorts(result, by=["sex", "age_cell"])
+#   c.mean, c.percentiles[90], c.prevalence, c.contribution
+#   c.to_frame()                  # one row per group (requires pandas)
+#
+# Several years score as one result (hcc_batch.concat) grouped by a year
+# label alongside any other key.
+
+sex_labels = np.array(["unknown", "male", "female"])
+orec_labels = np.array([str(o) for o in range(256)], dtype=object)
+orec_labels[[int(o) for o in EntitlementReason]] = [o.name for o in EntitlementReason]
+
+# the age cells of the regression variables (F0_34 ... F95_GT), as plain
+# closed bins
+age_cells = [label for label, _, _ in hcc_engine.age_bands]
+age_cell_bounds = np.array([lower for _, lower, _ in hcc_engine.age_bands[1:]])
+
+def age_cell(age):
+  return np.asarray(age_cells)[np.digitize(age, age_cell_bounds)]
+
+# one label per member for a grouping key
+def column(result, key):
+  if not isinstance(key, str):
+    labels = np.asarray(key)
+    if labels.ndim != 1 or len(labels) != len(result):
+      raise ValueError("%d cohort labels for %d members" % (len(labels), len(result)))
+    return labels
+  if key == "sex":
+    return sex_labels[np.where(result.sex <= 2, result.sex, 0)]
+  if key == "age_cell":
+    return age_cell(result.age)
+  if key == "medicaid":
+    return np.asarray(result.medicaid, dtype=bool)
+  if key == "orec":
+    return orec_labels[result.orec]
+  raise ValueError("unknown cohort key %r (sex, age_cell, medicaid, orec or a label per member)" % key)
+
+# by is None (one group), a key or a list of keys; a custom cohort is an
+# array of labels, so a list is always a list of keys
+def grouping(by):
+  if by is None:
+    return []
+  return list(by) if isinstance(by, (list, tuple)) else [by]
+
+# the group of every member and the label tuple of every group, in sorted
+# label order
+def group_codes(result, by=None):
+  keys = grouping(by)
+  if not keys:
+    return np.zeros(len(result), dtype=np.intp), [()]
+  code = np.zeros(len(result), dtype=np.intp)
+  uniques = []
+  for key in keys:
+    values, inverse = np.unique(column(result, key), return_inverse=True)
+    code = code * len(values) + inverse.reshape(-1)
+    uniques.append(values.tolist())
+  present, code = np.unique(code, return_inverse=True)
+  labels = []
+  for c in present.tolist():
+    label = []
+    for values in reversed(uniques):
+      c, i = divmod(c, len(values))
+      label.append(values[i])
+    labels.append(tuple(reversed(label)))
+  return code.reshape(-1), labels
+
+# percentiles of values within each run of a sorted order, interpolated
+# linearly as np.percentile does
+def group_percentiles(values, starts, counts, qs):
+  out = {}
+  for q in qs:
+    pos = starts + (counts - 1) * (q / 100.0)
+    lo = np.floor(pos).astype(np.intp)
+    hi = np.minimum(lo + 1, starts + counts - 1)
+    out[q] = values[lo] + (values[hi] - values[lo]) * (pos - lo)
+  return out
+
+class Cohorts:
+  def __init__(self, keys, labels, members, total, mean, percentiles, hccs, prevalence, contribution):
+    self.keys = keys                  # the grouping keys
+    self.labels = labels              # group -> label tuple
+    self.members = members            # group -> members
+    self.total = total                # group -> sum of scores
+    self.mean = mean
+    self.percentiles = percentiles    # q -> group -> score
+    self.hccs = hccs                  # the HCC variables, columns of the two below
+    self.prevalence = prevalence      # group x hcc, share of members with it
+    self.contribution = contribution  # group x hcc, share of the total score
+
+  def __len__(self):
+    return len(self.labels)
+
+  def __repr__(self):
+    return "Cohorts(groups=%d, members=%d)" % (len(self), int(self.members.sum()))
+
+  # the HCCs with the largest share of group g's score
+  def top_hccs(self, g, n=10):
+    order = np.argsort(-self.contribution[g], kind="stable")[:n]
+    return [(self.hccs[j], float(self.prevalence[g, j]), float(self.contribution[g, j])) for j in order]
+
+  # one dict per group, for JSON dashboards
+  def rows(self):
+    for g, label in enumerate(self.labels):
+      row = dict(zip(self.keys, label))
+      row.update(members=int(self.members[g]), total=float(self.total[g]), mean=float(self.mean[g]))
+      for q, values in self.percentiles.items():
+        row["p%g" % q] = float(values[g])
+      yield row
+
+  def to_frame(self):
+    import pandas as pd
+    return pd.DataFrame(list(self.rows()))
+
+  # long format: one row per group and HCC present in it
+  def hcc_frame(self):
+    import pandas as pd
+    g, j = np.nonzero(self.prevalence)
+    frame = pd.DataFrame([self.labels[i] for i in g.tolist()], columns=self.keys) if self.keys \
+      else pd.DataFrame(index=range(len(g)))
+    frame["hcc"] = np.asarray(self.hccs)[j]
+    frame["prevalence"] = self.prevalence[g, j]
+    frame["contribution"] = self.contribution[g, j]
+    return frame
+
+# grouped statistics of one model's scores; contributions use the
+# coefficients of the version the result was scored under (bt, when given,
+# must be its batch tables)
+def cohorts(result, by=None, model="community", percentiles=(50, 90, 99), bt=None):
+  bt = bt or hcc_batch.batch_tables(result.version)
+  if (result.version is not None and result.version != bt.name) or result.variables != bt.variables:
+    raise ValueError("result scored under %s, not the batch tables of %s" % (result.version, bt.name))
+  code, labels = group_codes(result, by)
+  scores = np.asarray(result.scores[model], dtype=np.float64)
+  order = np.lexsort((scores, code))
+  counts = np.bincount(code, minlength=len(labels))
+  starts = np.concatenate(([0], np.cumsum(counts)[:-1])).astype(np.intp)
+  total = np.bincount(code, weights=scores, minlength=len(labels))
+  mean = total / np.maximum(counts, 1)
+  quantiles = group_percentiles(scores[order], starts, counts, percentiles) if len(scores) \
+    else {q: np.zeros(len(labels)) for q in percentiles}
+
+  cols = [i for i, v in enumerate(result.variables) if v.startswith("HCC")]
+  hccs = [result.variables[i] for i in cols]
+  ind = result.indicators[:, cols]
+  if len(scores):
+    present = np.add.reduceat(ind[order].astype(np.float64), starts, axis=0)
+  else:
+    present = np.zeros((len(labels), len(cols)))
+  coef = bt.coefficients[model][cols]
+  prevalence = present / np.maximum(counts, 1)[:, None]
+  contribution = present * coef / np.where(total == 0, 1.0, total)[:, None]
+  keys = [k if isinstance(k, str) else "cohort" for k in grouping(by)]
+  return Cohorts(keys, labels, counts, total, mean,
+                 quantiles, hccs, prevalence, contribution)
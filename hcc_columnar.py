@@ -0,0 +1,100 @@
+import json
+import os
+import struct
+import numpy as np
+import hcc_batch
+import hcc_store
+
+# Columnar output of the output(B,Col,Val) table: one .npy file per column
+# group, appended a chunk at a time and loadable with np.load(mmap_mode="r").
+#   indicators.npy  uint8   member x variable, columns as in columns.json
+#   scores.npy      float64 member x model
+#   sex.npy         uint8   1 male, 2 female
+#   age.npy         int16
+#   hicno.txt       one HICNO per line, in row order
+# Each .npy header is written with a fixed length and rewritten with the
+# final row count on close, so rows stream straight to disk.
+
+HEADER_LEN = 256
+
+def npy_header(dtype, shape):
+  d = "{'descr': %r, 'fortran_order': False, 'shape': %r, }" % (
+    np.lib.format.dtype_to_descr(np.dtype(dtype)), tuple(shape))
+  body = d.ljust(HEADER_LEN - 10 - 1) + "\n"
+  return b"\x93NUMPY\x01\x00" + struct.pack("<H", len(body)) + body.encode("latin1")
+
+class NpyAppender:
+  def __init__(self, path, dtype, width=None):
+    self.dtype = np.dtype(dtype)
+    self.width = width
+    self.rows = 0
+    self.file = open(path, "wb")
+    self.file.write(npy_header(self.dtype, self.shape()))
+
+  def shape(self):
+    return (self.rows,) if self.width is None else (self.rows, self.width)
+
+  def append(self, values):
+    values = np.ascontiguousarray(values, dtype=self.dtype)
+    self.file.write(values.tobytes())
+    self.rows += len(values)
+
+  def close(self):
+    self.file.seek(0)
+    self.file.write(npy_header(self.dtype, self.shape()))
+    self.file.close()
+
+class ColumnarWriter:
+  def __init__(self, directory, variables=None, models=hcc_batch.models):
+    os.makedirs(directory, exist_ok=True)
+    self.directory = directory
+    self.variables = list(variables if variables is not None else hcc_batch.batch_tables().variables)
+    self.models = list(models)
+    self.indicators = NpyAppender(os.path.join(directory, "indicators.npy"), np.uint8, len(self.variables))
+    self.scores = NpyAppender(os.path.join(directory, "scores.npy"), np.float64, len(self.models))
+    self.sex = NpyAppender(os.path.join(directory, "sex.npy"), np.uint8)
+    self.age = NpyAppender(os.path.join(directory, "age.npy"), np.int16)
+    self.hicnos = open(os.path.join(directory, "hicno.txt"), "w")
+
+  def write(self, result):
+    if list(result.variables) != self.variables:
+      raise ValueError("result columns do not match the writer's variables")
+    self.indicators.append(result.indicators)
+    self.scores.append(np.column_stack([result.scores[m] for m in self.models]))
+    self.sex.append(result.sex)
+    self.age.append(result.age)
+    self.hicnos.writelines("%s\n" % h for h in result.hicnos)
+
+  def close(self):
+    for column in (self.indicators, self.scores, self.sex, self.age):
+      column.close()
+    self.hicnos.close()
+    with open(os.path.join(self.directory, "columns.json"), "w") as f:
+      json.dump({"rows": self.indicators.rows, "variables": self.variables,
+                 "models": self.models, "sex": {"1": "male", "2": "female"}}, f, indent=1)
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc):
+    self.close()
+
+def load(directory, mmap_mode="r"):
+  with open(os.path.join(directory, "columns.json")) as f:
+    columns = json.load(f)
+  out = {name: np.load(os.path.join(directory, name + ".npy"), mmap_mode=mmap_mode)
+         for name in ("indicators", "scores", "sex", "age")}
+  with open(os.path.join(directory, "hicno.txt")) as f:
+    out["hicno"] = [line.rstrip("\n") for line in f]
+  out["variables"] = columns["variables"]
+  out["models"] = columns["models"]
+  return out
+
+# hcc_io.score_files, writing the full wide table instead of the scores
+def score_files(person_path, diag_path, out_dir, chunk_size=10000, idvar="HICNO", key=str, delimiter=",", as_of=None):
+  count = 0
+  with ColumnarWriter(out_dir) as writer:
+    for store in hcc_store.read_chunks(person_path, diag_path, chunk_size, idvar, key, delimiter):
+      writer.write(hcc_batch.score_store(store, as_of=as_of))
+      count += len(store)
+  return count
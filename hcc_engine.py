@@ -0,0 +1,597 @@
+from functools import lru_cache
+import hcc
+import hcc_models
+import hcc_tables
+from hcc import EntitlementReason
+
+# The compiled engine: the facts loaded by hcc.load_facts() become plain
+# python dictionaries and sets, and every clause of hcc.load_rules() is
+# translated to the equivalent set operation.  Rules are translated as
+# written (bounds, argument order and all) so both engines agree.
+
+class Tables:
+  def __init__(self, version=None):
+    mv = version or hcc_models.get()
+    parsed = hcc_tables.parsed_tables(code_tables=mv.code_tables, coefficients=mv.coefficients,
+                                      hierarchy=mv.hierarchy)
+    self.name = mv.name
+    self.version = parsed.version
+    self.mapping_key = mv.mapping_key()
+    # cc(ICD,CC,Type)
+    self.cc = {}
+    for icdcodetype, pairs in parsed.cc.items():
+      for icdE,ccE in pairs:
+        self.cc.setdefault((icdE,icdcodetype),set()).add(ccE)
+    # overrides(OT,CC)
+    self.overrides = {}
+    for overrider, overridee in parsed.overrides:
+      self.overrides.setdefault(overrider,set()).add(overridee)
+    # dc(DC,CC)
+    self.dc = {}
+    for dcE, ccs in mv.diagnostic_categories:
+      self.dc.setdefault(dcE,set()).update(ccs)
+    # coefficient(Label,Coef)
+    self.coefficients = dict(parsed.coefficients)
+
+    self.sex_edits = {}
+    for icdtype,ccE,icds in mv.sex_edits:
+      for icd in icds:
+        self.sex_edits.setdefault((icd,icdtype),set()).add(ccE)
+    self.age_edits = {}
+    for icdtype,ccE,icds in mv.age_edits:
+      for icd in icds:
+        self.age_edits.setdefault((icd,icdtype),set()).add(ccE)
+    self.age_excisions = set()
+    for icdtype,icds in mv.age_excisions:
+      self.age_excisions.update((icd,icdtype) for icd in icds)
+
+    self.hccees = set(mv.hccees)
+    self.models = {model: (set(reg_vars), prefix)
+                   for model, (reg_vars, prefix) in mv.regressions.items()}
+    # variable -> coefficient for each model, for the variables that have one
+    self.model_coefficients = {}
+    for model, (reg_vars, prefix) in self.models.items():
+      self.model_coefficients[model] = {v: self.coefficients[prefix + v]
+                                        for v in reg_vars if prefix + v in self.coefficients}
+
+    self.interactions = mv.interactions(self.dc)
+    self.disabled_interactions = [(name, name[len("DISABLED_HCC"):])
+                                  for name in mv.disabled_interactions]
+
+    # the same tables as bitmasks: every cc is one bit of a python int, the
+    # hierarchy is a per-cc mask of the ccs it suppresses and every
+    # interaction is a pair of category masks
+    ccs = set(self.hccees) | set(self.overrides)
+    for mapped in list(self.cc.values()) + list(self.sex_edits.values()) + \
+                  list(self.age_edits.values()) + list(self.overrides.values()) + list(self.dc.values()):
+      ccs |= mapped
+    self.bit_ccs = sorted(ccs, key=lambda c: (len(c),c))
+    self.cc_bit = {c: 1 << i for i,c in enumerate(self.bit_ccs)}
+    self.cc_masks = {k: self.mask(v) for k,v in self.cc.items()}
+    self.sex_edit_masks = {k: self.mask(v) for k,v in self.sex_edits.items()}
+    self.age_edit_masks = {k: self.mask(v) for k,v in self.age_edits.items()}
+    self.suppress = [self.mask(self.overrides.get(c,())) for c in self.bit_ccs]
+    self.interaction_masks = [(name, self.mask(left), self.mask(right))
+                              for name, left, right in self.interactions]
+    self.disabled_masks = [(name, self.cc_bit[ccE]) for name, ccE in self.disabled_interactions]
+    # dc(CC,'pressure_ulcer'), argument order as in load_rules
+    self.disabled_pressure_ulcer_mask = self.mask(
+      c for c in self.bit_ccs if 'pressure_ulcer' in self.dc.get(c,()))
+    self.hccees_mask = self.mask(self.hccees)
+    self.hcc_vars = ['HCC' + c for c in self.bit_ccs]
+    self.plans = {}
+
+  def mask(self, ccs):
+    m = 0
+    for c in ccs:
+      m |= self.cc_bit[c]
+    return m
+
+  # the Plan for a set of models (all of them when models is None)
+  def plan(self, models=None):
+    key = tuple(sorted(models)) if models is not None else None
+    if key not in self.plans:
+      self.plans[key] = Plan(self, key)
+    return self.plans[key]
+
+  def ccs_of(self, m):
+    return [self.bit_ccs[i] for i in bits(m)]
+
+# What scoring a set of models needs, derived from their variable lists:
+# only the interactions, disabled interactions and HCC variables some model
+# reads are evaluated, and a set of purely demographic models (the new
+# enrollee model) never maps diagnoses at all.
+class Plan:
+  def __init__(self, t, models=None):
+    self.models = list(models) if models is not None else list(t.models)
+    for model in self.models:
+      if model not in t.models:
+        raise KeyError("unknown model %r (models: %s)" % (model, ", ".join(sorted(t.models))))
+    self.variables = set().union(*[t.models[model][0] for model in self.models])
+    self.interaction_masks = [i for i in t.interaction_masks if i[0] in self.variables]
+    self.disabled_masks = [d for d in t.disabled_masks if d[0] in self.variables]
+    self.disabled_pressure_ulcer_mask = t.disabled_pressure_ulcer_mask \
+      if 'DISABLED_PRESSURE_ULCER' in self.variables else 0
+    self.hccees_mask = t.mask(c for c in t.hccees if 'HCC' + c in self.variables)
+    self.diagnoses = bool(self.interaction_masks or self.disabled_masks or
+                          self.disabled_pressure_ulcer_mask or self.hccees_mask)
+
+  def __repr__(self):
+    return "Plan(%s, diagnoses=%s, interactions=%d)" % (
+      ",".join(self.models), self.diagnoses, len(self.interaction_masks))
+
+def bits(m):
+  while m:
+    low = m & -m
+    yield low.bit_length() - 1
+    m ^= low
+
+_tables = {}
+
+# the compiled tables of a registered model version, the default one when
+# name is None
+def tables(name=None):
+  name = name or hcc_models.default_name
+  if name not in _tables:
+    _tables[name] = Tables(hcc_models.get(name))
+  return _tables[name]
+
+# (label, lower, upper) as passed to sex_age_range
+age_bands = [("0_34",0,34), ("35_44",35,44), ("45_54",45,54), ("55_59",55,59),
+             ("60_64",60,64), ("65_69",65,69), ("70_74",70,74), ("75_79",75,79),
+             ("80_84",80,84), ("85_89",85,89), ("90_94",90,94), ("95_GT",95,-1.0)]
+
+# age_range(B,L,U): the lower bound is exclusive and an upper bound of -1.0 is open
+def age_range(a,lower,upper):
+  return a > lower and (upper == -1.0 or a <= upper)
+
+# sex_age(MF,B,A) <= sex_age_range(MF,B,(A+1),A)
+def sex_age(a,target):
+  return age_range(a,target+1,target)
+
+def disabled(b):
+  return b.disabled
+
+def originally_disabled(b):
+  return b.originally_disabled
+
+def diagnosis_keys(b):
+  return frozenset((diag.icdcode,diag.codetype) for diag in b.diagnoses)
+
+# beneficiary_has_cc for a set of (icd,type) keys as a cc mask; sex and the
+# under 18 edits are the only demographics the cc rules look at
+def cc_mask(keys, female, under18, t=None):
+  t = t or tables()
+  m = 0
+  for key in keys:
+    if under18 and key in t.age_excisions:
+      continue
+    edits = 0
+    if female:
+      edits |= t.sex_edit_masks.get(key,0)
+    if under18:
+      edits |= t.age_edit_masks.get(key,0)
+    m |= edits or t.cc_masks.get(key,0)
+  return m
+
+# beneficiary_has_hcc: drop every cc suppressed by another cc of the member
+def hcc_mask(m, t=None):
+  t = t or tables()
+  suppressed = 0
+  for i in bits(m):
+    suppressed |= t.suppress[i]
+  return m & ~suppressed
+
+# indicators that only depend on the hierarchical ccs; with a plan, only
+# those its models read
+def mask_indicators(h, dis, t=None, plan=None):
+  t = t or tables()
+  p = plan or t
+  ind = set()
+  if not h:
+    return ind
+  for name, left, right in p.interaction_masks:
+    if h & left and h & right:
+      ind.add(name)
+  if dis:
+    for name, bit in p.disabled_masks:
+      if h & bit:
+        ind.add(name)
+    if h & p.disabled_pressure_ulcer_mask:
+      ind.add('DISABLED_PRESSURE_ULCER')
+  for i in bits(h & p.hccees_mask):
+    ind.add(t.hcc_vars[i])
+  return ind
+
+def cc_set(keys, female, under18, t=None):
+  t = t or tables()
+  return set(t.ccs_of(cc_mask(keys, female, under18, t)))
+
+def beneficiary_has_cc(b, t=None):
+  return cc_set(diagnosis_keys(b), b.sex == "female", b.age < 18, t)
+
+def beneficiary_has_hcc(ccs, t=None):
+  t = t or tables()
+  return set(t.ccs_of(hcc_mask(t.mask(ccs), t)))
+
+def hcc_indicators(hccs, dis, t=None):
+  t = t or tables()
+  return mask_indicators(t.mask(hccs), dis, t)
+
+# indicators that only depend on sex, age, entitlement and medicaid; the
+# cells are computed once per distinct combination
+@lru_cache(maxsize=8192)
+def demographic_indicators(sex, a, orec, medicaid):
+  ind = set()
+  male = sex == "male"
+  female = sex == "female"
+  medicaid = medicaid == True
+  oasi = orec == EntitlementReason.OASI
+  dis = hcc.is_disabled(a,orec)
+  origds = hcc.is_originally_disabled(a,orec)
+
+  for fm, mf in (("F",female),("M",male)):
+    if not mf:
+      continue
+    for label, lower, upper in age_bands:
+      if age_range(a,lower,upper):
+        ind.add(fm + label)
+        if label not in ("60_64","65_69"):
+          ind.add("NE" + fm + label)
+    if age_range(a,60,63) or (sex_age(a,64) and not oasi):
+      ind.add("NE" + fm + "60_64")
+    if (sex_age(a,64) and oasi) or sex_age(a,65):
+      ind.add("NE" + fm + "65")
+    for single in range(66,70):
+      if sex_age(a,single):
+        ind.add("NE" + fm + str(single))
+
+    long_sex = "FEMALE" if fm == "F" else "MALE"
+    title_sex = long_sex.title()
+    if medicaid:
+      if age_range(a,0,64):
+        ind.add('MCAID_' + long_sex + '0_64')
+      if sex_age(a,65):
+        ind.add('MCAID_' + long_sex + '65')
+      if age_range(a,66,69):
+        ind.add('MCAID_' + long_sex + '66_69')
+      if age_range(a,70,74):
+        ind.add('MCAID_' + long_sex + '70_74')
+      if age_range(a,75,-1.0):
+        ind.add('MCAID_' + long_sex + '75_GT')
+      if not dis:
+        ind.add('MCAID_' + title_sex + '_Aged')
+
+    if origds:
+      ne = "NE" + fm
+      origdis = 'Origdis_' + long_sex.lower()
+      if ne + '65' in ind:
+        ind.add(origdis + '65')
+      if any(ne + str(single) in ind for single in range(66,70)):
+        ind.add(origdis + '66_69')
+      if ne + '70_74' in ind:
+        ind.add(origdis + '70_74')
+      if age_range(a,74,-1.0):
+        ind.add(origdis + '75_GT')
+      ind.add('OriginallyDisabled_' + title_sex)
+
+  if medicaid:
+    ind.add('MCAID')
+    # both disabled medicaid indicators are keyed on male(B) in load_rules
+    if dis and male:
+      ind.add('MCAID_Female_Disabled')
+      ind.add('MCAID_Male_Disabled')
+  if origds:
+    ind.add('ORIGDS')
+  return frozenset(ind)
+
+def indicators(b, hccs, t=None):
+  return demographic_indicators(b.sex, b.age, b.original_reason_entitlement, b.medicaid) | \
+    hcc_indicators(hccs, disabled(b), t)
+
+# Memoizes beneficiary_has_hcc for members that share a diagnosis set.  The
+# key is the canonical set of (icd,type) plus the two demographics the edit
+# and excision rules read, so members who differ only in age band (above 18)
+# or OREC share an entry.
+class HCCCache:
+  def __init__(self, maxsize=65536, t=None):
+    self.tables = t or tables()
+    self.resolve = lru_cache(maxsize=maxsize)(self._resolve)
+
+  def _resolve(self, keys, female, under18):
+    return hcc_mask(cc_mask(keys, female, under18, self.tables), self.tables)
+
+  def hcc_mask(self, b):
+    return self.resolve(diagnosis_keys(b), b.sex == "female", b.age < 18)
+
+  def hccs(self, b):
+    return frozenset(self.tables.ccs_of(self.hcc_mask(b)))
+
+  def info(self):
+    return self.resolve.cache_info()
+
+  def hit_rate(self):
+    info = self.info()
+    return info.hits / float(info.hits + info.misses) if info.hits + info.misses else 0.0
+
+  def clear(self):
+    self.resolve.cache_clear()
+
+def beneficiary_hcc_mask(b, t=None, cache=None):
+  if cache is not None:
+    return cache.hcc_mask(b)
+  t = t or tables()
+  return hcc_mask(cc_mask(diagnosis_keys(b), b.sex == "female", b.age < 18, t), t)
+
+def beneficiary_hccs(b, t=None, cache=None):
+  t = t or tables()
+  return set(t.ccs_of(beneficiary_hcc_mask(b,t,cache)))
+
+def beneficiary_indicators(b, t=None, cache=None, plan=None):
+  t = t or tables()
+  demographics = demographic_indicators(b.sex, b.age, b.original_reason_entitlement, b.medicaid)
+  if plan is not None and not plan.diagnoses:
+    return demographics
+  return demographics | mask_indicators(beneficiary_hcc_mask(b,t,cache), disabled(b), t, plan)
+
+def model_score(ind, model, t=None):
+  t = t or tables()
+  coefficients = t.model_coefficients[model]
+  return sum(coefficients[var] for var in sorted(ind) if var in coefficients)
+
+def score(b, model, t=None, cache=None):
+  t = t or tables()
+  return model_score(beneficiary_indicators(b,t,cache,t.plan([model])), model, t)
+
+# every model's score and valid_*_variables string from one indicator set
+# (for the given models only, when models is not None)
+def model_scores(ind, t=None, models=None):
+  t = t or tables()
+  out = {}
+  for model in models if models is not None else t.models:
+    reg_vars = t.models[model][0]
+    valid = sorted(ind & reg_vars)
+    coefficients = t.model_coefficients[model]
+    out[model] = sum(coefficients[var] for var in valid if var in coefficients)
+    out["valid_%s_variables" % model] = ",".join(valid)
+  return out
+
+def score_all(b, t=None, cache=None, models=None):
+  t = t or tables()
+  plan = t.plan(models)
+  return model_scores(beneficiary_indicators(b,t,cache,plan), t, plan.models)
+
+# (hicno, model_scores) for every member of an hcc_store.MemberStore, ages
+# taken on as_of; a plan for models that read no diagnoses skips them
+def score_store(store, t=None, as_of=None, models=None):
+  t = t or tables()
+  plan = t.plan(models)
+  keys = store.codes.keys
+  offsets = store.offsets.tolist()
+  diagnoses = store.diagnoses.tolist()
+  rows = zip(store.hicnos, store.sex.tolist(), store.ages(as_of).tolist(),
+             store.orec.tolist(), store.medicaid.tolist())
+  for i, (hicno, sex, age, orec, medicaid) in enumerate(rows):
+    sex = "male" if sex == 1 else "female"
+    ind = demographic_indicators(sex, age, orec, medicaid)
+    if plan.diagnoses:
+      m = cc_mask(frozenset(keys[c] for c in diagnoses[offsets[i]:offsets[i+1]]), sex == "female", age < 18, t)
+      ind = ind | mask_indicators(hcc_mask(m,t), hcc.is_disabled(age,orec), t, plan)
+    yield hicno, model_scores(ind, t, plan.models)
+
+# score_all under several registered model versions (all of them when names
+# is None).  The icd -> cc mapping runs once per mapping_key; versions that
+# share it reuse the cc mask, translated when their cc bits differ.
+def score_versions(b, names=None):
+  keys = diagnosis_keys(b)
+  female, under18 = b.sex == "female", b.age < 18
+  demographics = demographic_indicators(b.sex, b.age, b.original_reason_entitlement, b.medicaid)
+  dis = disabled(b)
+  mapped = {}
+  out = {}
+  for name in names or hcc_models.names():
+    t = tables(name)
+    if t.mapping_key not in mapped:
+      mapped[t.mapping_key] = (t, cc_mask(keys, female, under18, t))
+    first, m = mapped[t.mapping_key]
+    if first.bit_ccs != t.bit_ccs:
+      m = t.mask(first.ccs_of(m))
+    out[name] = model_scores(demographics | mask_indicators(hcc_mask(m,t), dis, t), t)
+  return out
+
+# Keeps a member's derived state (diagnosis and cc reference counts, the cc
+# and hcc masks, the indicators and a running score per model) so adding or
+# removing a diagnosis only revisits what that diagnosis touches: the ccs it
+# maps to, the ccs those suppress, the indicators reading any changed hcc
+# and the coefficients of indicators that switched on or off.
+class MemberState:
+  def __init__(self, b, t=None):
+    self.tables = t = t or tables()
+    self.beneficiary = b
+    self.female = b.sex == "female"
+    self.under18 = b.age < 18
+    self.disabled = disabled(b)
+    self.keys = {}
+    self.cc_counts = [0] * len(t.bit_ccs)
+    self.suppressor_counts = [0] * len(t.bit_ccs)
+    self.cc_mask = 0
+    self.suppressed_mask = 0
+    self.hcc_mask = 0
+    self.indicators = set(demographic_indicators(b.sex, b.age, b.original_reason_entitlement, b.medicaid))
+    self.scores = {model: 0.0 for model in t.models}
+    self._switch(self.indicators, set())
+    for diag in b.diagnoses:
+      self._add_key((diag.icdcode,diag.codetype))
+    self._update()
+
+  def add_diagnosis(self, diag):
+    self.beneficiary.add_diagnosis(diag)
+    self._add_key((diag.icdcode,diag.codetype))
+    return self._update()
+
+  def remove_diagnosis(self, diag):
+    self.beneficiary.remove_diagnosis(diag)
+    self._remove_key((diag.icdcode,diag.codetype))
+    return self._update()
+
+  def key_mask(self, key):
+    return cc_mask((key,), self.female, self.under18, self.tables)
+
+  def _add_key(self, key):
+    self.keys[key] = self.keys.get(key,0) + 1
+    if self.keys[key] == 1:
+      for i in bits(self.key_mask(key)):
+        self.cc_counts[i] += 1
+        if self.cc_counts[i] == 1:
+          self._set_cc(i, 1)
+
+  def _remove_key(self, key):
+    self.keys[key] -= 1
+    if self.keys[key] == 0:
+      del self.keys[key]
+      for i in bits(self.key_mask(key)):
+        self.cc_counts[i] -= 1
+        if self.cc_counts[i] == 0:
+          self._set_cc(i, -1)
+
+  def _set_cc(self, i, step):
+    self.cc_mask ^= 1 << i
+    for j in bits(self.tables.suppress[i]):
+      self.suppressor_counts[j] += step
+      if self.suppressor_counts[j] == (1 if step > 0 else 0):
+        self.suppressed_mask ^= 1 << j
+
+  # re-derive the indicators reading any hcc that changed; returns the
+  # indicators switched (on, off)
+  def _update(self):
+    h = self.cc_mask & ~self.suppressed_mask
+    on, off = self._changes(h)
+    self.hcc_mask = h
+    if not on and not off:
+      return on, off
+    self.indicators = (self.indicators | on) - off
+    self._switch(on, off)
+    return on, off
+
+  # the indicators that would switch (on, off) if the hcc mask became h
+  def _changes(self, h):
+    t = self.tables
+    changed = h ^ self.hcc_mask
+    if not changed:
+      return set(), set()
+    new, old = set(), set()
+    for name, left, right in t.interaction_masks:
+      if changed & (left | right):
+        (new if h & left and h & right else old).add(name)
+    if self.disabled:
+      for name, bit in t.disabled_masks:
+        if changed & bit:
+          (new if h & bit else old).add(name)
+      if changed & t.disabled_pressure_ulcer_mask:
+        (new if h & t.disabled_pressure_ulcer_mask else old).add('DISABLED_PRESSURE_ULCER')
+    for i in bits(changed & t.hccees_mask):
+      (new if h >> i & 1 else old).add(t.hcc_vars[i])
+    return new - self.indicators, old & self.indicators
+
+  def _switch(self, on, off):
+    for model, coefficients in self.tables.model_coefficients.items():
+      self.scores[model] += sum(coefficients.get(v,0.0) for v in sorted(on)) - \
+                            sum(coefficients.get(v,0.0) for v in sorted(off))
+
+  def hccs(self):
+    return set(self.tables.ccs_of(self.hcc_mask))
+
+  # the ccs a what-if candidate adds: "HCC85" is the cc itself; a Diagnosis,
+  # an (icd,type) key or a bare ICD10 code goes through the member's edits
+  # and excisions like a real diagnosis; a list is a group of candidates
+  # documented together
+  def candidate_mask(self, candidate):
+    t = self.tables
+    if isinstance(candidate, list):
+      m = 0
+      for c in candidate:
+        m |= self.candidate_mask(c)
+      return m
+    if isinstance(candidate, hcc.Diagnosis):
+      return self.key_mask((candidate.icdcode,candidate.codetype))
+    if isinstance(candidate, str) and candidate.upper().startswith("HCC"):
+      cc = candidate[3:]
+      if cc not in t.cc_bit:
+        raise ValueError("unknown HCC %r" % candidate)
+      return t.cc_bit[cc]
+    if isinstance(candidate, str):
+      candidate = (candidate, hcc.ICDType.TEN)
+    icd, codetype = candidate
+    return self.key_mask((hcc.normalize_icd(icd),int(codetype)))
+
+  # the change a candidate would make to the member, read off the current
+  # masks and indicators without touching them
+  def marginal(self, candidate):
+    t = self.tables
+    added = self.candidate_mask(candidate) & ~self.cc_mask
+    suppressed = self.suppressed_mask
+    for i in bits(added):
+      suppressed |= t.suppress[i]
+    h = (self.cc_mask | added) & ~suppressed
+    on, off = self._changes(h)
+    deltas = {model: sum(coefficients.get(v,0.0) for v in sorted(on)) -
+                     sum(coefficients.get(v,0.0) for v in sorted(off))
+              for model, coefficients in t.model_coefficients.items()}
+    return WhatIf(candidate, deltas, on, off,
+                  set(t.ccs_of(h & ~self.hcc_mask)), set(t.ccs_of(self.hcc_mask & ~h)))
+
+  def what_if(self, candidates):
+    return [self.marginal(c) for c in candidates]
+
+# The marginal effect of documenting a candidate: the score delta per model,
+# the indicators switched on and off, and the hccs gained and lost (an hcc
+# that outranks one the member has replaces it)
+class WhatIf:
+  def __init__(self, candidate, deltas, on, off, gained, lost):
+    self.candidate = candidate
+    self.deltas = deltas
+    self.on = on
+    self.off = off
+    self.gained = gained
+    self.lost = lost
+
+  def __repr__(self):
+    return "WhatIf(%r, %s)" % (self.candidate, ", ".join(
+      "%s=%+.3f" % (model, delta) for model, delta in sorted(self.deltas.items())))
+
+# marginal deltas for a list of candidates from one MemberState, rather than
+# a rescoring of the member per candidate
+def what_if(b, candidates, t=None):
+  return MemberState(b, t).what_if(candidates)
+
+# MemberStates by HICNO; apply() touches only the members with new claims and
+# reports which members' scores moved since the last call to changed()
+class IncrementalScorer:
+  def __init__(self, t=None):
+    self.tables = t or tables()
+    self.members = {}
+    self._changed = set()
+
+  def add_member(self, b):
+    self.members[b.hicno] = MemberState(b, self.tables)
+    self._changed.add(b.hicno)
+
+  def apply(self, hicno, added=(), removed=()):
+    state = self.members[hicno]
+    moved = False
+    for diag in added:
+      on, off = state.add_diagnosis(diag)
+      moved = moved or on or off
+    for diag in removed:
+      on, off = state.remove_diagnosis(diag)
+      moved = moved or on or off
+    if moved:
+      self._changed.add(hicno)
+    return state.scores
+
+  def changed(self):
+    changed, self._changed = self._changed, set()
+    return changed
+
+  def what_if(self, hicno, candidates):
+    return self.members[hicno].what_if(candidates)
@@ -0,0 +1,98 @@
+import numpy as np
+import hcc_engine
+import hcc_models
+from hcc import ICDType, normalize_icd
+
+# Index of the cc(ICD,CC,Type) facts.  Every (icd,type) pair the rules read
+# (the code tables, the sex and age edits and the age excisions) gets an
+# integer code id and every cc the id of its bit in the compiled tables
+# (hcc_engine.Tables.bit_ccs), so a code id maps to its ccs through CSR
+# arrays:
+#   ccs of code i = cc_ids[offsets[i]:offsets[i+1]]
+# which keeps the one-to-many rows (B377 maps to both CC 2 and CC 6).  Codes
+# are normalized before they are looked up ("e11.9 " finds E119).  Besides
+# a dict per code type for single lookups, each type has its codes in a
+# sorted array, so lookup_many resolves a whole column of diagnoses with
+# numpy string operations and np.searchsorted.  The batch engine resolves
+# its diagnoses through the index of its model version: code ids are the
+# rows of its key tables (hcc_batch.BatchTables.keys).
+
+class ICDIndex:
+  def __init__(self, t=None):
+    t = t or hcc_engine.tables()
+    self.ccs = list(t.bit_ccs)                  # cc id -> cc
+    self.cc_id = {c:i for i,c in enumerate(self.ccs)}
+    keys = set(t.cc) | set(t.sex_edits) | set(t.age_edits) | t.age_excisions
+    self.codes = sorted(keys, key=lambda k: (k[1],k[0]))   # code id -> (icd, type)
+    self.ids = {}                               # type -> {icd: code id}
+    offsets, cc_ids = [0], []
+    for id, (icd, codetype) in enumerate(self.codes):
+      self.ids.setdefault(codetype, {})[icd] = id
+      cc_ids.extend(sorted(self.cc_id[c] for c in t.cc.get((icd,codetype),())))
+      offsets.append(len(cc_ids))
+    self.offsets = np.array(offsets, dtype=np.int64)
+    self.cc_ids = np.array(cc_ids, dtype=np.int32)
+    self.sorted = {}                            # type -> (sorted icds, their code ids)
+    for codetype, ids in self.ids.items():
+      icds = sorted(ids)
+      self.sorted[codetype] = (np.array(icds, dtype=str),
+                               np.array([ids[icd] for icd in icds], dtype=np.int64))
+
+  def __len__(self):
+    return len(self.codes)
+
+  def code_id(self, icd, codetype=ICDType.TEN):
+    return self.ids.get(int(codetype), {}).get(normalize_icd(icd), -1)
+
+  # the ccs of one code, [] when it maps to none
+  def lookup(self, icd, codetype=ICDType.TEN):
+    id = self.code_id(icd, codetype)
+    if id < 0:
+      return []
+    return [self.ccs[c] for c in self.cc_ids[self.offsets[id]:self.offsets[id + 1]]]
+
+  # code ids for a column of codes (-1 when unmapped); codetypes is one type
+  # for the whole column or one per code
+  def code_ids(self, codes, codetypes=ICDType.TEN):
+    codes = np.asarray(codes, dtype=str)
+    if not codes.size:
+      return np.full(codes.shape, -1, dtype=np.int64)
+    codes = np.char.upper(np.char.replace(np.char.strip(codes), ".", ""))
+    types = np.broadcast_to(np.asarray(codetypes, dtype=np.int64), codes.shape)
+    out = np.full(codes.shape, -1, dtype=np.int64)
+    for codetype, (icds, ids) in self.sorted.items():
+      rows = np.flatnonzero(types == codetype)
+      if not len(rows) or not len(icds):
+        continue
+      wanted = codes[rows]
+      pos = np.minimum(np.searchsorted(icds, wanted), len(icds) - 1)
+      hit = icds[pos] == wanted
+      out[rows[hit]] = ids[pos[hit]]
+    return out
+
+  # code ids for a list of (icd, type) keys
+  def key_ids(self, keys):
+    if not len(keys):
+      return np.zeros(0, dtype=np.int64)
+    icds, codetypes = zip(*keys)
+    return self.code_ids(icds, np.array(codetypes, dtype=np.int64))
+
+  # every (row, cc id) pair of a column of codes, one pair per cc a code
+  # maps to; self.ccs names the cc ids
+  def lookup_many(self, codes, codetypes=ICDType.TEN):
+    ids = self.code_ids(codes, codetypes)
+    known = np.flatnonzero(ids >= 0)
+    starts = self.offsets[ids[known]]
+    counts = self.offsets[ids[known] + 1] - starts
+    rows = np.repeat(known, counts)
+    within = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    return rows, self.cc_ids[np.repeat(starts, counts) + within]
+
+_indexes = {}
+
+# the index of a registered model version's code tables
+def index(name=None):
+  name = name or hcc_models.default_name
+  if name not in _indexes:
+    _indexes[name] = ICDIndex(hcc_engine.tables(name))
+  return _indexes[name]
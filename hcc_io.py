@@ -0,0 +1,105 @@
+import csv
+from itertools import groupby, islice
+import hcc_batch
+from hcc import Beneficiary, Diagnosis, EntitlementReason, ICDType
+
+# Streaming readers for the CMS SAS input layout (see CMS-sas/V2116H1M.SAS):
+#   person file:    HICNO, DOB, SEX, OREC, MCAID, NEMCAID
+#   diagnosis file: HICNO, DIAG, DIAG_TYPE ('9' for ICD9, '0' for ICD10)
+# Both files are sorted by HICNO, as the SAS MERGE BY step requires, so
+# members can be built and scored a chunk at a time.
+
+score_columns = ["SCORE_COMMUNITY", "SCORE_INSTITUTIONAL", "SCORE_NEW_ENROLLEE"]
+
+sexes = {"1":"male", "2":"female", "M":"male", "F":"female",
+         "MALE":"male", "FEMALE":"female"}
+
+def read_rows(path, delimiter=","):
+  with open(path, newline='') as f:
+    reader = csv.reader(f, delimiter=delimiter)
+    header = [h.strip().upper() for h in next(reader)]
+    for row in reader:
+      if row:
+        yield dict(zip(header, (v.strip() for v in row)))
+
+def flag(value):
+  return value.upper() in ("1", "Y", "YES", "T", "TRUE")
+
+# (hicno, sex, dob, orec, medicaid, nemcaid) of a person row, the leading
+# arguments of both Beneficiary and hcc_store.MemberStoreBuilder.append
+def person_fields(row, idvar="HICNO"):
+  sex = row["SEX"].upper()
+  if sex not in sexes:
+    raise ValueError("unknown SEX %r for %s %s" % (row["SEX"], idvar, row[idvar]))
+  return (row[idvar], sexes[sex],
+          row["DOB"].replace("-",""),
+          EntitlementReason(int(row.get("OREC") or 0)),
+          flag(row.get("MCAID","0")),
+          flag(row.get("NEMCAID","0")))
+
+def person_beneficiary(row, idvar="HICNO", as_of=None):
+  return Beneficiary(*person_fields(row, idvar), as_of)
+
+# merge the two sorted streams BY idvar, like step3.3 of V2116H1M, yielding
+# each person row with its diagnosis rows; diagnoses without a person are
+# dropped and out-of-order input raises a ValueError
+def read_members(person_path, diag_path, idvar="HICNO", key=str, delimiter=","):
+  diag_groups = groupby(read_rows(diag_path, delimiter), lambda row: key(row[idvar]))
+  pending = next(diag_groups, None)
+  last = None
+  for row in read_rows(person_path, delimiter):
+    current = key(row[idvar])
+    if last is not None and current < last:
+      raise ValueError("person file is not sorted by %s at %s" % (idvar, row[idvar]))
+    last = current
+    while pending is not None and pending[0] < current:
+      pending = next(diag_groups, None)
+    diagnoses = []
+    if pending is not None and pending[0] == current:
+      diagnoses = list(pending[1])
+      following = next(diag_groups, None)
+      if following is not None and following[0] <= current:
+        raise ValueError("diagnosis file is not sorted by %s at %s" % (idvar, following[0]))
+      pending = following
+    yield row, diagnoses
+
+def diagnosis_type(row):
+  return ICDType(int(row.get("DIAG_TYPE") or 9))
+
+# Beneficiary objects for the merged files.  Ages are taken as of as_of
+# (see hcc.payment_year_as_of), today by default.
+def read_beneficiaries(person_path, diag_path, idvar="HICNO", key=str, delimiter=",", as_of=None):
+  for row, diagnoses in read_members(person_path, diag_path, idvar, key, delimiter):
+    b = person_beneficiary(row, idvar, as_of)
+    for diag in diagnoses:
+      b.add_diagnosis(Diagnosis(b, diag["DIAG"], diagnosis_type(diag)))
+    yield b
+
+def chunked(iterable, size):
+  iterator = iter(iterable)
+  while True:
+    chunk = list(islice(iterator, size))
+    if not chunk:
+      return
+    yield chunk
+
+# score every member of the person file, writing one row per member; memory
+# is bounded by chunk_size rather than by the size of the input files, and
+# members are read into hcc_store chunks rather than Beneficiary objects.
+# With an hcc_results.ResultCache only the members not cached are scored.
+def score_files(person_path, diag_path, out_path, chunk_size=10000, idvar="HICNO", key=str, delimiter=",",
+                as_of=None, cache=None):
+  import hcc_store
+  count = 0
+  with open(out_path, "w", newline='') as out:
+    writer = csv.writer(out, delimiter=delimiter)
+    writer.writerow([idvar] + score_columns)
+    for store in hcc_store.read_chunks(person_path, diag_path, chunk_size, idvar, key, delimiter):
+      if cache is not None:
+        scores = cache.score_store(store, as_of)
+      else:
+        scores = hcc_batch.score_store(store, as_of=as_of).scores
+      for i, hicno in enumerate(store.hicnos):
+        writer.writerow([hicno] + [repr(float(scores[m][i])) for m in hcc_batch.models])
+      count += len(store)
+  return count
@@ -0,0 +1,193 @@
+import json
+import os
+import numpy as np
+import hcc
+import hcc_batch
+import hcc_io
+import hcc_store
+from hcc_columnar import NpyAppender
+
+# Longitudinal scoring.  A diagnosis file that carries a service date
+#   HICNO, DIAG, DIAG_TYPE, DIAG_DATE (YYYYMMDD or YYYY-MM-DD)
+# is scored for several service years in one pass over the merged person
+# and diagnosis files: every member is scored once per year on that year's
+# diagnoses, with ages on February 1 of the following (payment) year, as
+# the prospective model is run.  Each year's scores and HCC sets go to a
+# store directory:
+#   years.json           the years, the HCC variables and the models
+#   <year>/hicno.txt     one HICNO per line, in row order
+#   <year>/scores.npy    float64 member x model
+#   <year>/hccs.npy      uint8   member x HCC variable, bit-packed
+# Year-over-year deltas are read from the store, so scoring a new year only
+# scores that year:
+#
+#   store = hcc_longitudinal.score_years("person.csv","diag.csv","hcc_years",[2015,2016])
+#   d = store.delta(2015, 2016)
+#   d.member("000000042")     # {"gained": [...], "dropped": [...], "change": {...}}
+
+class YearWriter:
+  def __init__(self, directory, hccs, models=hcc_batch.models):
+    os.makedirs(directory, exist_ok=True)
+    self.hccs = list(hccs)
+    self.models = list(models)
+    self.scores = NpyAppender(os.path.join(directory, "scores.npy"), np.float64, len(self.models))
+    self.packed = NpyAppender(os.path.join(directory, "hccs.npy"), np.uint8, (len(self.hccs) + 7) // 8)
+    self.hicnos = open(os.path.join(directory, "hicno.txt"), "w")
+
+  def write(self, result):
+    cols = [result.variables.index(h) for h in self.hccs]
+    self.scores.append(np.column_stack([result.scores[m] for m in self.models]))
+    self.packed.append(np.packbits(result.indicators[:, cols].astype(bool), axis=1))
+    self.hicnos.writelines("%s\n" % h for h in result.hicnos)
+
+  def close(self):
+    self.scores.close()
+    self.packed.close()
+    self.hicnos.close()
+    return self.scores.rows
+
+# one stored year: scores per model and a member x HCC bool matrix
+class Year:
+  def __init__(self, year, hicnos, scores, hccs, names):
+    self.year = year
+    self.hicnos = hicnos
+    self.scores = scores    # model -> float array
+    self.hccs = hccs        # member x HCC variable, bool
+    self.names = names      # the HCC variables
+    self._rows = None
+
+  def __len__(self):
+    return len(self.hicnos)
+
+  def __repr__(self):
+    return "Year(%d, members=%d)" % (self.year, len(self))
+
+  def row(self, hicno):
+    if self._rows is None:
+      self._rows = {h: i for i, h in enumerate(self.hicnos)}
+    return self._rows[hicno]
+
+  def hccs_of(self, hicno):
+    return [self.names[j] for j in np.flatnonzero(self.hccs[self.row(hicno)])]
+
+# the changes between two stored years for the members in both: HCCs
+# gained and dropped (member x HCC) and the score change per model.
+# Members scored in only one year are listed in added and removed.
+class YearDelta:
+  def __init__(self, before, after):
+    self.years = (before.year, after.year)
+    self.names = after.names
+    index = {h: i for i, h in enumerate(before.hicnos)}
+    rows = np.array([index.get(h, -1) for h in after.hicnos], dtype=np.intp)
+    common = rows >= 0
+    self.hicnos = [h for h, c in zip(after.hicnos, common.tolist()) if c]
+    self.added = [h for h, c in zip(after.hicnos, common.tolist()) if not c]
+    kept = set(self.hicnos)
+    self.removed = [h for h in before.hicnos if h not in kept]
+    old, new = before.hccs[rows[common]], after.hccs[common]
+    self.gained = new & ~old
+    self.dropped = old & ~new
+    self.change = {m: after.scores[m][common] - before.scores[m][rows[common]] for m in after.scores}
+    self._rows = None
+
+  def __len__(self):
+    return len(self.hicnos)
+
+  def __repr__(self):
+    return "YearDelta(%d -> %d, members=%d)" % (self.years + (len(self),))
+
+  def member(self, hicno):
+    if self._rows is None:
+      self._rows = {h: i for i, h in enumerate(self.hicnos)}
+    i = self._rows[hicno]
+    return {"gained": [self.names[j] for j in np.flatnonzero(self.gained[i])],
+            "dropped": [self.names[j] for j in np.flatnonzero(self.dropped[i])],
+            "change": {m: float(v[i]) for m, v in self.change.items()}}
+
+  # members gaining and dropping each HCC
+  def hcc_counts(self):
+    return {h: (int(g), int(d)) for h, g, d in
+            zip(self.names, self.gained.sum(axis=0), self.dropped.sum(axis=0)) if g or d}
+
+class LongitudinalStore:
+  def __init__(self, directory):
+    self.directory = directory
+    self.meta_path = os.path.join(directory, "years.json")
+    self.meta = {"years": {}, "hccs": None, "models": None}
+    if os.path.exists(self.meta_path):
+      with open(self.meta_path) as f:
+        self.meta = json.load(f)
+
+  def years(self):
+    return sorted(int(y) for y in self.meta["years"])
+
+  def writer(self, year, bt):
+    hccs = [v for v in bt.variables if v.startswith("HCC")]
+    if self.meta["hccs"] is not None and self.meta["hccs"] != hccs:
+      raise ValueError("%s holds years scored with other HCC variables" % self.directory)
+    self.meta["hccs"], self.meta["models"] = hccs, list(hcc_batch.models)
+    return YearWriter(os.path.join(self.directory, str(year)), hccs)
+
+  def record(self, year, rows, as_of, bt):
+    self.meta["years"][str(year)] = {"rows": rows, "as_of": as_of.strftime("%Y-%m-%d"),
+                                     "version": bt.name}
+    os.makedirs(self.directory, exist_ok=True)
+    with open(self.meta_path, "w") as f:
+      json.dump(self.meta, f, indent=1)
+
+  def load(self, year, mmap_mode="r"):
+    if str(year) not in self.meta["years"]:
+      raise KeyError("year %s is not in %s (stored: %s)" % (year, self.directory, self.years()))
+    directory = os.path.join(self.directory, str(year))
+    with open(os.path.join(directory, "hicno.txt")) as f:
+      hicnos = [line.rstrip("\n") for line in f]
+    scores = np.load(os.path.join(directory, "scores.npy"), mmap_mode=mmap_mode)
+    packed = np.load(os.path.join(directory, "hccs.npy"), mmap_mode=mmap_mode)
+    names = self.meta["hccs"]
+    hccs = np.unpackbits(packed, axis=1, count=len(names)).astype(bool)
+    return Year(int(year), hicnos, {m: scores[:, j] for j, m in enumerate(self.meta["models"])},
+                hccs, names)
+
+  def delta(self, before, after):
+    return YearDelta(self.load(before), self.load(after))
+
+# the service year of a diagnosis row
+def service_year(row, column="DIAG_DATE"):
+  value = row.get(column)
+  if not value:
+    raise ValueError("diagnosis of %s has no %s" % (row.get("HICNO", "?"), column))
+  return int(value[:4])
+
+# score the merged files once per service year in one pass, writing each
+# year to the store in directory; years already stored are replaced
+def score_years(person_path, diag_path, directory, years, chunk_size=10000, idvar="HICNO",
+                key=str, delimiter=",", date_column="DIAG_DATE", version=None):
+  years = sorted(set(int(y) for y in years))
+  if not years:
+    raise ValueError("no service years to score")
+  bt = hcc_batch.batch_tables(version)
+  store = LongitudinalStore(directory)
+  writers = {y: store.writer(y, bt) for y in years}
+  as_of = {y: hcc.payment_year_as_of(y + 1) for y in years}
+  builders = {y: hcc_store.MemberStoreBuilder() for y in years}
+
+  def flush():
+    for y in years:
+      writers[y].write(hcc_batch.score_store(builders[y].build(), bt, as_of[y]))
+      builders[y] = hcc_store.MemberStoreBuilder()
+
+  for row, diagnoses in hcc_io.read_members(person_path, diag_path, idvar, key, delimiter):
+    by_year = {y: [] for y in years}
+    for diag in diagnoses:
+      y = service_year(diag, date_column)
+      if y in by_year:
+        by_year[y].append(diag)
+    for y in years:
+      builders[y].append_rows(row, by_year[y], idvar)
+    if len(builders[years[0]]) >= chunk_size:
+      flush()
+  if len(builders[years[0]]):
+    flush()
+  for y in years:
+    store.record(y, writers[y].close(), as_of[y], bt)
+  return store
@@ -0,0 +1,95 @@
+import hcc
+
+# Registry of model versions.  A ModelVersion names everything that differs
+# between CMS releases: the icd -> cc code tables, the coefficients, the
+# hierarchy, the dc categories, the hccees list, the sex/age edits and
+# excisions, the regression variable lists and the interactions.  Anything
+# left out is taken from the tables bundled with hcc.py, so a blend-year
+# version is usually a few overrides:
+#
+#   hcc_models.register(hcc_models.ModelVersion("V22",
+#     code_tables=[("v22/icd10.txt",0), ("v22/icd9.txt",9)],
+#     coefficients="v22/coefficients.txt"))
+#
+# Compiled tables are built once per version (hcc_engine.tables(name),
+# hcc_batch.batch_tables(name)).  Versions with the same code tables and
+# edits share a mapping_key, and the multi-version scorers map a member's
+# diagnoses to ccs once per mapping_key rather than once per version.
+
+default_name = "V21"
+
+# lines 363 - 368, the pairs joined by the interaction indicators
+def default_interactions(dc):
+  return [
+    ('ART_OPENINGS_PRESSURE_ULCER', dc["pressure_ulcer"], {"188"}),
+    ('ASP_SPEC_BACT_PNEUM_PRES_ULC', dc["pressure_ulcer"], {"114"}),
+    ('CANCER_IMMUNE', dc["cancer"], dc["immune"]),
+    ('CHF_COPD', dc["chf"], dc["copd"]),
+    ('CHF_RENAL', dc["chf"], dc["renal"]),
+    ('COPD_ASP_SPEC_BACT_PNEUM', dc["copd"], {"114"}),
+    ('COPD_CARD_RESP_FAIL', dc["copd"], dc["card_resp_fail"]),
+    ('DIABETES_CHF', dc["diabetes"], dc["chf"]),
+    ('SCHIZOPHRENIA_CHF', dc["chf"], {"57"}),
+    ('SCHIZOPHRENIA_COPD', dc["copd"], {"57"}),
+    ('SCHIZOPHRENIA_SEIZURES', {"79"}, {"57"}),
+    ('SEPSIS_ARTIF_OPENINGS', dc["sepsis"], {"188"}),
+    ('SEPSIS_ASP_SPEC_BACT_PNEUM', dc["sepsis"], {"114"}),
+    ('SEPSIS_CARD_RESP_FAIL', dc["sepsis"], dc["card_resp_fail"]) ]
+  # sepsis_pressure_ulcer is defined in load_rules but no indicator uses it
+
+def default_disabled_interactions():
+  return ['DISABLED_HCC110', 'DISABLED_HCC161', 'DISABLED_HCC176', 'DISABLED_HCC34',
+          'DISABLED_HCC39', 'DISABLED_HCC46', 'DISABLED_HCC54', 'DISABLED_HCC55',
+          'DISABLED_HCC6', 'DISABLED_HCC77', 'DISABLED_HCC85']
+
+def default_regressions():
+  return {"community": (hcc.community_regression(), "CE_"),
+          "institutional": (hcc.institutional_regression(), "INS_"),
+          "new_enrollee": (hcc.new_enrollee_regression(), "NE_")}
+
+class ModelVersion:
+  def __init__(self, name, code_tables=None, coefficients=None, hierarchy=None,
+               diagnostic_categories=None, hccees=None, sex_edits=None, age_edits=None,
+               age_excisions=None, regressions=None, interactions=None,
+               disabled_interactions=None):
+    self.name = name
+    self.code_tables = code_tables              # [(file, icd type)]
+    self.coefficients = coefficients            # coefficient file
+    self.hierarchy = hierarchy if hierarchy is not None else hcc.hierarchy()
+    self.diagnostic_categories = diagnostic_categories if diagnostic_categories is not None \
+      else hcc.diagnostic_categories()
+    self.hccees = hccees if hccees is not None else hcc.hccees()
+    self.sex_edits = sex_edits if sex_edits is not None else hcc.sex_edits()
+    self.age_edits = age_edits if age_edits is not None else hcc.age_edits()
+    self.age_excisions = age_excisions if age_excisions is not None else hcc.age_excisions()
+    # model -> (regression variables, coefficient prefix)
+    self.regressions = regressions if regressions is not None else default_regressions()
+    # dc categories -> [(name, left ccs, right ccs)]
+    self.interactions = interactions or default_interactions
+    self.disabled_interactions = disabled_interactions if disabled_interactions is not None \
+      else default_disabled_interactions()
+
+  # everything the icd -> cc mapping (with edits and excisions) depends on
+  def mapping_key(self):
+    code_tables = self.code_tables if self.code_tables is not None else hcc.code_tables()
+    return repr((list(code_tables), self.sex_edits, self.age_edits, self.age_excisions))
+
+  def __repr__(self):
+    return "ModelVersion(%r)" % self.name
+
+_versions = {}
+
+def register(version):
+  _versions[version.name] = version
+  return version
+
+def get(name=None):
+  name = name or default_name
+  if name not in _versions:
+    raise KeyError("unknown model version %r (registered: %s)" % (name, ", ".join(names())))
+  return _versions[name]
+
+def names():
+  return sorted(_versions)
+
+register(ModelVersion(default_name))
@@ -0,0 +1,70 @@
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+import csv
+import hcc_batch
+import hcc_io
+import hcc_store
+
+# Sharded scoring on a process pool.  pyDatalog keeps global state, so the
+# pool runs separate processes; each worker loads the code tables, the
+# hierarchy and the coefficients once in its initializer and then scores
+# shards of member records with the same hcc_batch.score_records() used
+# serially.  Shards are contiguous runs of the (HICNO sorted) input and are
+# merged back in input order, so the output matches the serial path exactly.
+
+def _init_worker():
+  hcc_batch.batch_tables()
+
+def _score_shard(records):
+  return hcc_batch.score_records(records)
+
+def _store_scores(args):
+  store, as_of = args
+  result = hcc_batch.score_store(store, as_of=as_of)
+  return result.hicnos, result.scores
+
+def shards(records, shard_size):
+  iterator = iter(records)
+  while True:
+    shard = list(islice(iterator, shard_size))
+    if not shard:
+      return
+    yield shard
+
+# like executor.map, but keeps at most `window` shards in flight so a
+# stream of any length is scored in bounded memory
+def imap_ordered(executor, fn, iterable, window):
+  pending = deque()
+  for item in iterable:
+    pending.append(executor.submit(fn, item))
+    if len(pending) >= window:
+      yield pending.popleft().result()
+  while pending:
+    yield pending.popleft().result()
+
+def executor(workers=None):
+  return ProcessPoolExecutor(max_workers=workers or os.cpu_count(), initializer=_init_worker)
+
+def score_population(beneficiaries, workers=None, shard_size=10000):
+  records = [hcc_batch.member_record(b) for b in beneficiaries]
+  with executor(workers) as pool:
+    results = list(pool.map(_score_shard, shards(records, shard_size)))
+  return hcc_batch.concat(results)
+
+# the parallel counterpart of hcc_io.score_files
+def score_files(person_path, diag_path, out_path, workers=None, shard_size=10000,
+                idvar="HICNO", key=str, delimiter=",", as_of=None):
+  workers = workers or os.cpu_count()
+  stores = ((store, as_of) for store in
+            hcc_store.read_chunks(person_path, diag_path, shard_size, idvar, key, delimiter))
+  count = 0
+  with executor(workers) as pool, open(out_path, "w", newline='') as out:
+    writer = csv.writer(out, delimiter=delimiter)
+    writer.writerow([idvar] + hcc_io.score_columns)
+    for hicnos, scores in imap_ordered(pool, _store_scores, stores, 2 * workers):
+      for i, hicno in enumerate(hicnos):
+        writer.writerow([hicno] + [repr(float(scores[m][i])) for m in hcc_batch.models])
+      count += len(hicnos)
+  return count
@@ -0,0 +1,200 @@
+import argparse
+import json
+import os
+import sys
+import numpy as np
+import hcc
+import hcc_batch
+import hcc_io
+import hcc_parallel
+from hcc import EntitlementReason
+
+# Differential check of this package against the CMS SAS software.  The
+# person and diagnosis files that went into V2116H1P are streamed through
+# hcc_io, the dataset V2116H1M wrote (exported to CSV, one row per person,
+# KEEPVAR columns such as HICNO SCORE_COMMUNITY AGEF DISABL NEM65 HCC85
+# DISABLED_HCC85 ...) is streamed beside them, and shards of matched members
+# are scored and compared on the hcc_parallel process pool.  Every column
+# the SAS file shares with ours is compared (hcc_io upper-cases the SAS
+# header, so variables match whatever their case); mismatches are grouped
+# by variable, and SAS indicator columns (0/1 throughout) that match no
+# variable of ours are listed:
+#   python hcc_parity.py person.csv diag.csv sas_results.csv --year 2016
+
+# SAS column -> member record field, for the columns that are not indicators
+demographic_columns = {"AGEF": 2}
+
+# person file fields V2116H1M carries over; flags, but not indicators
+person_columns = {"DOB", "SEX", "OREC", "NEMCAID"}
+
+def sas_value(value):
+  value = value.strip()
+  if value in ("", "."):
+    return 0.0
+  return float(value)
+
+# merge the records with the SAS rows BY idvar; both are sorted, as the SAS
+# output is written in the order of its MERGE
+def join(records, sas_rows, idvar="HICNO", key=str):
+  sas_rows = iter(sas_rows)
+  pending = next(sas_rows, None)
+  for record in records:
+    current = key(record[0])
+    while pending is not None and key(pending[idvar]) < current:
+      yield None, pending
+      pending = next(sas_rows, None)
+    if pending is not None and key(pending[idvar]) == current:
+      yield record, pending
+      pending = next(sas_rows, None)
+    else:
+      yield record, None
+  while pending is not None:
+    yield None, pending
+    pending = next(sas_rows, None)
+
+class ParityReport:
+  def __init__(self, max_examples=20):
+    self.max_examples = max_examples
+    self.members = 0
+    self.compared = set()
+    self.unmatched = set()  # SAS indicator columns with no variable of ours
+    self.counts = {}       # variable -> members that disagree
+    self.examples = {}     # variable -> [(hicno, sas, python)]
+    self.missing = {"sas": [], "python": []}  # first max_examples HICNOs
+    self.missing_counts = {"sas": 0, "python": 0}
+
+  # a member on one side of the join only; side is "sas" or "python"
+  def add_missing(self, side, hicno):
+    self.missing_counts[side] += 1
+    if len(self.missing[side]) < self.max_examples:
+      self.missing[side].append(hicno)
+
+  def merge(self, shard):
+    members, compared, unmatched, mismatches = shard
+    self.members += members
+    self.compared |= set(compared)
+    self.unmatched |= set(unmatched)
+    for variable, count, examples in mismatches:
+      self.counts[variable] = self.counts.get(variable, 0) + count
+      kept = self.examples.setdefault(variable, [])
+      kept.extend(examples[:self.max_examples - len(kept)])
+
+  def ok(self):
+    return not self.counts and not any(self.missing_counts.values())
+
+  def to_dict(self):
+    return {"members": self.members,
+            "ok": self.ok(),
+            "compared": sorted(self.compared),
+            "unmatched_sas_columns": sorted(self.unmatched),
+            "mismatches": {v: {"members": self.counts[v], "examples": self.examples[v]}
+                           for v in sorted(self.counts)},
+            "missing_in_sas": {"members": self.missing_counts["sas"], "examples": self.missing["sas"]},
+            "missing_in_python": {"members": self.missing_counts["python"], "examples": self.missing["python"]}}
+
+  def summary(self):
+    lines = ["%d members compared on %d variables" % (self.members, len(self.compared))]
+    for v in sorted(self.counts, key=lambda v: (-self.counts[v], v)):
+      lines.append("  %-28s %d members, e.g. %s" % (v, self.counts[v],
+        ", ".join("%s (sas %s, python %s)" % e for e in self.examples[v][:3])))
+    if self.unmatched:
+      lines.append("  %d SAS indicator columns match no variable: %s" %
+                   (len(self.unmatched), ", ".join(sorted(self.unmatched))))
+    if self.missing_counts["sas"]:
+      lines.append("  %d members missing from the SAS output" % self.missing_counts["sas"])
+    if self.missing_counts["python"]:
+      lines.append("  %d SAS rows with no person record" % self.missing_counts["python"])
+    if self.ok():
+      lines.append("  no differences")
+    return "\n".join(lines)
+
+# the SAS columns of a shard whose values are all 0 or 1
+def indicator_columns(rows, columns):
+  flags = ("", ".", "0", "1")
+  return [c for c in columns if all(row[c].strip() in flags for row in rows)]
+
+# compare one shard of (record, sas row) pairs; runs on the pool, so it
+# returns plain tuples rather than a report
+def compare_shard(pairs, tolerance=1e-6, max_examples=20, idvar="HICNO"):
+  records = [record for record, _ in pairs]
+  result = hcc_batch.score_records(records)
+  columns = set(pairs[0][1])
+  python = {}
+  sas_column = {}   # variable -> its column in the SAS file
+  for column, model in zip(hcc_io.score_columns, hcc_batch.models):
+    if column in columns:
+      python[column] = result.scores[model]
+  for i, v in enumerate(result.variables):
+    if v.upper() in columns:
+      python[v] = result.indicators[:,i]
+      sas_column[v] = v.upper()
+  for column, field in demographic_columns.items():
+    if column in columns:
+      python[column] = np.array([r[field] for r in records])
+  if "DISABL" in columns:
+    python["DISABL"] = np.array([r[2] < 65 and r[3] != EntitlementReason.OASI for r in records])
+
+  mismatches = []
+  for column, values in python.items():
+    sas = np.array([sas_value(row[sas_column.get(column, column)]) for _, row in pairs])
+    off = np.flatnonzero(np.abs(sas - values.astype(np.float64)) > tolerance)
+    if len(off):
+      mismatches.append((column, len(off),
+                         [(records[i][0], sas[i], float(values[i])) for i in off[:max_examples]]))
+  used = set(sas_column.get(column, column) for column in python) | person_columns | {idvar}
+  unmatched = indicator_columns([row for _, row in pairs], sorted(columns - used))
+  return len(records), sorted(python), unmatched, mismatches
+
+def _compare(args):
+  return compare_shard(*args)
+
+def compare_files(person_path, diag_path, sas_path, workers=None, shard_size=10000,
+                  idvar="HICNO", key=str, delimiter=",", as_of=None,
+                  tolerance=1e-6, max_examples=20):
+  report = ParityReport(max_examples)
+  records = (hcc_batch.member_record(b) for b in
+             hcc_io.read_beneficiaries(person_path, diag_path, idvar, key, delimiter, as_of))
+  sas_rows = hcc_io.read_rows(sas_path, delimiter)
+
+  def matched():
+    for record, row in join(records, sas_rows, idvar, key):
+      if row is None:
+        report.add_missing("sas", record[0])
+      elif record is None:
+        report.add_missing("python", row[idvar])
+      else:
+        yield record, row
+
+  workers = workers or os.cpu_count()
+  tasks = ((shard, tolerance, max_examples, idvar) for shard in hcc_parallel.shards(matched(), shard_size))
+  with hcc_parallel.executor(workers) as pool:
+    for shard in hcc_parallel.imap_ordered(pool, _compare, tasks, 2 * workers):
+      report.merge(shard)
+  return report
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description="Compare scores and indicators with the CMS SAS output.")
+  parser.add_argument("person")
+  parser.add_argument("diag")
+  parser.add_argument("sas", help="V2116H1M output dataset exported to CSV")
+  parser.add_argument("--year", type=int, default=2016,
+                      help="payment year of the SAS run (DATE_ASOF is Feb 1 of it)")
+  parser.add_argument("--workers", type=int, default=None)
+  parser.add_argument("--shard-size", type=int, default=10000)
+  parser.add_argument("--idvar", default="HICNO")
+  parser.add_argument("--delimiter", default=",")
+  parser.add_argument("--tolerance", type=float, default=1e-6)
+  parser.add_argument("--max-examples", type=int, default=20)
+  parser.add_argument("--json", help="also write the report as JSON to this path")
+  args = parser.parse_args(argv)
+  report = compare_files(args.person, args.diag, args.sas, args.workers, args.shard_size,
+                         args.idvar, str, args.delimiter, hcc.payment_year_as_of(args.year),
+                         args.tolerance, args.max_examples)
+  print(report.summary())
+  if args.json:
+    with open(args.json, "w") as f:
+      json.dump(report.to_dict(), f, indent=1)
+  return 0 if report.ok() else 1
+
+if __name__ == "__main__":
+  sys.exit(main())
@@ -0,0 +1,173 @@
+import importlib
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+# Opt-in per-stage timings for the scoring pipeline.  enable() wraps the
+# functions listed in `probes` in their modules (and classes), so every call
+# adds its wall time, a call and the rows it produced to a Stats object;
+# disable() puts the originals back.  Nothing is wrapped while profiling is
+# off, so the hot paths run exactly as they do without this module.
+#
+#   with hcc_profile.profiling() as stats:
+#     hcc_batch.score_population(members)
+#   print(stats.prometheus())
+#
+# The rule stages of the Datalog engine run inside pyDatalog's resolver and
+# cannot be timed one by one; its queries are covered by the "score" stage
+# (compute_score).  compute_scores is its own "score_all" stage, which
+# includes the time of the compute_score calls it makes, so the two are not
+# to be added up.
+# The compiled engines apply the sex and age edits and the under 18
+# excisions in the same pass as the icd -> cc lookup, so they are part of
+# the "cc_mapping" stage, with the edited and excised diagnoses counted in
+# the batch engine.  Stats are per process; hcc_parallel workers keep their
+# own.
+
+def popcount(m):
+  return bin(m).count("1")
+
+def nonzero(a):
+  return int(a.sum())
+
+def length(x):
+  return len(x)
+
+# nearest-rank percentile of a list of latencies (0.0 for none), for the
+# benchmark and the service's metrics
+def percentile(values, q):
+  if not values:
+    return 0.0
+  ordered = sorted(values)
+  return ordered[min(len(ordered) - 1, int(q / 100.0 * len(ordered)))]
+
+# (module, class or None, function, stage, rows produced by a result)
+probes = [
+  ("hcc", None, "load_facts", "load_facts", None),
+  ("hcc", None, "load_rules", "load_rules", None),
+  ("hcc", None, "compute_score", "score", None),
+  ("hcc", None, "compute_scores", "score_all", None),
+  ("hcc_tables", None, "parse_tables", "parse_tables", None),
+  ("hcc_tables", None, "read_cache", "read_cache", None),
+  ("hcc_engine", "Tables", "__init__", "compile_tables", None),
+  ("hcc_engine", None, "cc_mask", "cc_mapping", popcount),
+  ("hcc_engine", None, "hcc_mask", "hierarchy", popcount),
+  ("hcc_engine", None, "demographic_indicators", "demographics", length),
+  ("hcc_engine", None, "mask_indicators", "indicators", length),
+  ("hcc_engine", None, "model_score", "aggregation", None),
+  ("hcc_engine", None, "model_scores", "aggregation", None),
+  ("hcc_batch", "BatchTables", "__init__", "batch.compile_tables", None),
+  ("hcc_batch", None, "cc_matrix", "batch.cc_mapping", nonzero),
+  ("hcc_batch", None, "hcc_matrix", "batch.hierarchy", nonzero),
+  ("hcc_batch", None, "indicator_matrix", "batch.indicators", nonzero),
+  ("hcc_batch", None, "aggregate", "batch.aggregation", None),
+]
+
+class Stats:
+  def __init__(self):
+    self.reset()
+
+  def reset(self):
+    self.seconds = {}   # stage -> wall seconds
+    self.calls = {}     # stage -> calls
+    self.rows = {}      # stage -> rows produced
+    self.counters = {}  # name -> count
+
+  def add(self, stage, seconds, rows=None):
+    self.seconds[stage] = self.seconds.get(stage, 0.0) + seconds
+    self.calls[stage] = self.calls.get(stage, 0) + 1
+    if rows is not None:
+      self.rows[stage] = self.rows.get(stage, 0) + rows
+
+  def count(self, name, n=1):
+    self.counters[name] = self.counters.get(name, 0) + n
+
+  @contextmanager
+  def time(self, stage):
+    start = time.perf_counter()
+    try:
+      yield
+    finally:
+      self.add(stage, time.perf_counter() - start)
+
+  def snapshot(self):
+    return {"stages": {s: {"seconds": self.seconds[s], "calls": self.calls[s],
+                           "rows": self.rows.get(s)} for s in sorted(self.seconds)},
+            "counters": dict(sorted(self.counters.items()))}
+
+  def prometheus(self, prefix="hcc"):
+    lines = []
+    def family(name, help, samples):
+      lines.append("# HELP %s_%s %s" % (prefix, name, help))
+      lines.append("# TYPE %s_%s counter" % (prefix, name))
+      for labels, value in samples:
+        lines.append("%s_%s%s %r" % (prefix, name, labels, value))
+    stage = lambda s: '{stage="%s"}' % s
+    family("stage_seconds_total", "Wall time spent in each scoring stage.",
+           [(stage(s), v) for s, v in sorted(self.seconds.items())])
+    family("stage_calls_total", "Calls made to each scoring stage.",
+           [(stage(s), v) for s, v in sorted(self.calls.items())])
+    family("stage_rows_total", "Rows (ccs, hccs, indicators) produced by each stage.",
+           [(stage(s), v) for s, v in sorted(self.rows.items())])
+    for name, value in sorted(self.counters.items()):
+      family(name.replace(".", "_") + "_total", "Count of %s." % name, [("", value)])
+    return "\n".join(lines) + "\n"
+
+def probe(fn, stage, rows, stats):
+  @wraps(fn)
+  def timed(*args, **kwargs):
+    start = time.perf_counter()
+    result = fn(*args, **kwargs)
+    stats.add(stage, time.perf_counter() - start, rows(result) if rows else None)
+    return result
+  return timed
+
+# HCCCache.hcc_mask, counting hits and misses of its lru_cache
+def cache_probe(fn, stats):
+  @wraps(fn)
+  def counted(self, b):
+    hits = self.resolve.cache_info().hits
+    result = fn(self, b)
+    stats.count("hcc_cache.hits" if self.resolve.cache_info().hits > hits else "hcc_cache.misses")
+    return result
+  return counted
+
+current = None
+_originals = []
+
+def _targets():
+  for module, cls, name, stage, rows in probes:
+    owner = importlib.import_module(module)
+    if cls is not None:
+      owner = getattr(owner, cls)
+    yield owner, name, stage, rows
+
+def enable(stats=None):
+  global current
+  if current is not None:
+    return current
+  current = stats or Stats()
+  for owner, name, stage, rows in _targets():
+    fn = owner.__dict__[name]
+    _originals.append((owner, name, fn))
+    setattr(owner, name, probe(fn, stage, rows, current))
+  cache = importlib.import_module("hcc_engine").HCCCache
+  _originals.append((cache, "hcc_mask", cache.__dict__["hcc_mask"]))
+  cache.hcc_mask = cache_probe(cache.__dict__["hcc_mask"], current)
+  return current
+
+def disable():
+  global current
+  while _originals:
+    owner, name, fn = _originals.pop()
+    setattr(owner, name, fn)
+  stats, current = current, None
+  return stats
+
+@contextmanager
+def profiling(stats=None):
+  stats = enable(stats)
+  try:
+    yield stats
+  finally:
+    disable()
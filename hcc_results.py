@@ -0,0 +1,256 @@
+import hashlib
+import os
+import sqlite3
+import struct
+import numpy as np
+import hcc
+import hcc_batch
+import hcc_store
+import hcc_tables
+from hcc import Engine
+
+# Persistent cache of member scores, in a SQLite file next to the parsed
+# tables cache.  A member's key is a digest of what the rules read from it
+# (sex, age on the as-of date, OREC, medicaid and the set of diagnosis
+# keys) and of the model version it was scored under: the digest of the
+# code tables, coefficients and hierarchy (hcc_tables.tables_version) plus
+# the regressions, interactions and edits of hcc_models.  Members whose
+# inputs did not change since an earlier run are read back instead of
+# scored.  Each engine keeps its own entries, as their sums can differ in
+# the last bits: a store's misses are scored with the batch engine as one
+# store, Beneficiary objects with hcc.compute_scores (pyDatalog by default,
+# where a hit saves the most).
+#
+# When the tables of a model version change, or FORMAT_VERSION does, its
+# entries are deleted the next time the cache is opened for that version.
+# Entries carry the run that last used them, and the least recently used
+# are evicted once the cache holds more than max_entries, or, with
+# max_bytes, once the pages in use (not the free pages deletes leave in the
+# file) take more than max_bytes; the file is then packed (VACUUM) below
+# the cap.  The entry count is kept in the meta table
+# and changed in the transaction of every write, so it stays exact when
+# several processes share the file.
+#
+#   cache = hcc_results.ResultCache()
+#   scores = cache.score_store(store, as_of=payment_year_as_of(2017))
+#   scores = cache.score_beneficiaries(beneficiary_list)
+#   cache.hits, cache.misses
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS versions (id INTEGER PRIMARY KEY, name TEXT UNIQUE NOT NULL, digest TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS results (key BLOB PRIMARY KEY, version INTEGER NOT NULL,
+                                    scores BLOB NOT NULL, used INTEGER NOT NULL) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS results_used ON results (used);
+CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value INTEGER NOT NULL);
+"""
+
+LOOKUP_BATCH = 500
+
+# the scoring code's part of the entry keys; bump it when a change to the
+# engines or to the layout of an entry changes what a stored score means
+FORMAT_VERSION = 1
+
+# share of max_bytes the cache is packed down to when it goes over
+FILL = 0.9
+
+def default_path():
+  return os.path.join(hcc_tables.cache_dir(), "results.sqlite")
+
+# sets sorted, so the repr of a table does not depend on hash order
+def canonical(x):
+  if isinstance(x, (set, frozenset)):
+    return sorted(canonical(v) for v in x)
+  if isinstance(x, dict):
+    return sorted((canonical(k), canonical(v)) for k, v in x.items())
+  if isinstance(x, (list, tuple)):
+    return [canonical(v) for v in x]
+  return x
+
+# everything a score depends on besides the member
+def scoring_version(bt):
+  t = bt.engine_tables
+  return hashlib.sha256(repr((FORMAT_VERSION, t.version, t.mapping_key, canonical(t.models),
+                              canonical(t.interactions), canonical(t.disabled_interactions),
+                              canonical(t.hccees))).encode()).hexdigest()
+
+def member_key(digest, engine, sex, age, orec, medicaid, keys):
+  text = "%s|%s|%d|%d|%d|%d|%s" % (digest, engine, sex, age, orec, medicaid,
+                                ";".join("%s,%d" % k for k in sorted(set(keys))))
+  return hashlib.blake2b(text.encode(), digest_size=16).digest()
+
+class ResultCache:
+  def __init__(self, path=None, max_entries=5000000, version=None, max_bytes=None):
+    self.path = path or default_path()
+    os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+    self.max_entries = max_entries
+    self.max_bytes = max_bytes
+    self.bt = hcc_batch.batch_tables(version)
+    self.digest = scoring_version(self.bt)
+    self.hits = 0
+    self.misses = 0
+    self.db = sqlite3.connect(self.path)
+    self.db.executescript(SCHEMA)
+    with self.db:
+      self.db.execute("INSERT OR IGNORE INTO meta SELECT 'entries', COUNT(*) FROM results")
+      self.version_id = self._version()
+      run = self.db.execute("SELECT value FROM meta WHERE name = 'run'").fetchone()
+      self.run = (run[0] if run else 0) + 1
+      self.db.execute("INSERT OR REPLACE INTO meta VALUES ('run', ?)", (self.run,))
+    self.evict()
+
+  # this version's id; its entries are dropped when its tables changed
+  def _version(self):
+    row = self.db.execute("SELECT id, digest FROM versions WHERE name = ?", (self.bt.name,)).fetchone()
+    if row and row[1] == self.digest:
+      return row[0]
+    if row:
+      self._count(-self.db.execute("DELETE FROM results WHERE version = ?", (row[0],)).rowcount)
+      self.db.execute("UPDATE versions SET digest = ? WHERE id = ?", (self.digest, row[0]))
+      return row[0]
+    return self.db.execute("INSERT INTO versions (name, digest) VALUES (?, ?)",
+                           (self.bt.name, self.digest)).lastrowid
+
+  # inside the transaction of the write that added or deleted the entries
+  def _count(self, change):
+    self.db.execute("UPDATE meta SET value = value + ? WHERE name = 'entries'", (change,))
+
+  @property
+  def entries(self):
+    return self.db.execute("SELECT value FROM meta WHERE name = 'entries'").fetchone()[0]
+
+  # bytes of the pages in use, without the free pages deletes leave behind
+  def nbytes(self):
+    pages = self.db.execute("PRAGMA page_count").fetchone()[0]
+    free = self.db.execute("PRAGMA freelist_count").fetchone()[0]
+    return (pages - free) * self.db.execute("PRAGMA page_size").fetchone()[0]
+
+  def __len__(self):
+    return self.entries
+
+  def __repr__(self):
+    return "ResultCache(%r, entries=%d, hits=%d, misses=%d)" % (self.path, self.entries, self.hits, self.misses)
+
+  def close(self):
+    self.db.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc):
+    self.close()
+
+  # the cache key of every member of a store
+  def keys(self, store, as_of=None):
+    codes = store.codes.keys
+    offsets = store.offsets.tolist()
+    diagnoses = store.diagnoses.tolist()
+    rows = zip(store.sex.tolist(), store.ages(as_of).tolist(), store.orec.tolist(), store.medicaid.tolist())
+    return [member_key(self.digest, "batch", sex, age, orec, medicaid,
+                       [codes[c] for c in diagnoses[offsets[i]:offsets[i+1]]])
+            for i, (sex, age, orec, medicaid) in enumerate(rows)]
+
+  def beneficiary_key(self, b, engine=Engine.DATALOG):
+    return member_key(self.digest, Engine(engine).name, hcc_store.sex_codes.get(b.sex, 0), b.age,
+                      int(b.original_reason_entitlement), b.medicaid == True,
+                      [(diag.icdcode, int(diag.codetype)) for diag in b.diagnoses])
+
+  # key -> scores tuple for the keys found
+  def lookup(self, keys):
+    found = {}
+    for start in range(0, len(keys), LOOKUP_BATCH):
+      batch = keys[start:start + LOOKUP_BATCH]
+      rows = self.db.execute("SELECT key, scores FROM results WHERE key IN (%s)" %
+                             ",".join("?" * len(batch)), batch).fetchall()
+      found.update((key, struct.unpack("<%dd" % len(hcc_batch.models), scores)) for key, scores in rows)
+    return found
+
+  # existing entries are updated, and only the new ones counted
+  def put(self, entries):
+    rows = [(self.version_id, struct.pack("<%dd" % len(scores), *scores), self.run, key)
+            for key, scores in entries]
+    with self.db:
+      self.db.executemany("UPDATE results SET version = ?, scores = ?, used = ? WHERE key = ?", rows)
+      added = self.db.executemany("INSERT OR IGNORE INTO results (version, scores, used, key) "
+                                  "VALUES (?, ?, ?, ?)", rows).rowcount
+      self._count(added)
+    self.evict()
+
+  def touch(self, keys):
+    with self.db:
+      self.db.executemany("UPDATE results SET used = ? WHERE key = ? AND used < ?",
+                          ((self.run, key, self.run) for key in keys))
+
+  def evict(self):
+    excess = self.entries - self.max_entries
+    if excess > 0:
+      self._drop(excess)
+    if self.max_bytes and self.nbytes() > self.max_bytes:
+      # deleted rows leave partly filled pages behind, so drop entries and
+      # pack the file until it fits, down to FILL of the cap so the next
+      # writes do not go over it at once
+      target = int(self.max_bytes * FILL)
+      while self.entries:
+        used = self.nbytes()
+        if used <= target:
+          break
+        self._drop(max(1, -(-self.entries * (used - target) // used)))
+        self.db.execute("VACUUM")
+
+  # the n least recently used entries
+  def _drop(self, n):
+    with self.db:
+      self._count(-self.db.execute("DELETE FROM results WHERE key IN "
+                                   "(SELECT key FROM results ORDER BY used LIMIT ?)", (n,)).rowcount)
+
+  # every model's score for the members of an hcc_store.MemberStore, ages
+  # taken on as_of; only the members not in the cache are scored
+  def score_store(self, store, as_of=None):
+    keys = self.keys(store, as_of)
+    found = self.lookup(list(set(keys)))
+    scores = {m: np.zeros(len(store)) for m in hcc_batch.models}
+    missing = []
+    for i, key in enumerate(keys):
+      if key in found:
+        for m, value in zip(hcc_batch.models, found[key]):
+          scores[m][i] = value
+      else:
+        missing.append(i)
+    self.hits += len(keys) - len(missing)
+    self.misses += len(missing)
+    self.touch(list(found))
+    if missing:
+      result = hcc_batch.score_store(store.take(missing), self.bt, as_of)
+      entries = {}
+      for j, i in enumerate(missing):
+        for m in hcc_batch.models:
+          scores[m][i] = result.scores[m][j]
+        entries[keys[i]] = tuple(float(result.scores[m][j]) for m in hcc_batch.models)
+      self.put(entries.items())
+    return scores
+
+  # every model's score for each beneficiary, as hcc.compute_scores computes
+  # it for the cache's model version; only the members not cached are scored
+  def score_beneficiaries(self, beneficiaries, engine=Engine.DATALOG):
+    beneficiaries = list(beneficiaries)
+    keys = [self.beneficiary_key(b, engine) for b in beneficiaries]
+    found = self.lookup(list(set(keys)))
+    self.touch(list(found))
+    out = []
+    entries = {}
+    for b, key in zip(beneficiaries, keys):
+      if key in found or key in entries:
+        self.hits += 1
+        out.append(dict(zip(hcc_batch.models, found.get(key) or entries[key])))
+        continue
+      self.misses += 1
+      scores = hcc.compute_scores(b, engine, self.bt.name)
+      entries[key] = tuple(float(scores[m]) for m in hcc_batch.models)
+      out.append(dict(zip(hcc_batch.models, entries[key])))
+    if entries:
+      self.put(entries.items())
+    return out
+
+  def clear(self):
+    with self.db:
+      self.db.execute("DELETE FROM results")
+      self.db.execute("UPDATE meta SET value = 0 WHERE name = 'entries'")
@@ -0,0 +1,331 @@
+import argparse
+import asyncio
+import json
+import time
+from collections import deque
+from datetime import datetime
+import hcc
+import hcc_batch
+import hcc_io
+import hcc_store
+from hcc import EntitlementReason, ICDType
+from hcc_profile import percentile
+
+# A small HTTP/JSON scoring service on asyncio, with no dependencies beyond
+# the library.  The tables are loaded once at startup, and concurrent
+# requests are micro-batched: the batch task takes every request already
+# queued, waits up to max_delay for more when several arrived together (a
+# lone request on an idle service goes straight through), and scores all
+# their members with a single hcc_batch.score_store call.
+#
+#   POST /score    {"member": {...}} or {"members": [{...}, ...]}, with
+#                  optional "as_of": "2017-02-01" and "version": "V21"
+#   GET  /metrics  Prometheus text; /metrics?format=json for JSON
+#   GET  /health
+#
+# A member is {"hicno": "1", "sex": "female", "dob": "19480415", "orec": 0,
+# "medicaid": false, "nemcaid": false, "diagnoses": ["E119", ["2860", 9]]}
+# where a bare code is ICD10.  Each member comes back as {"hicno": ...,
+# "community": ..., "institutional": ..., "new_enrollee": ...}.
+#
+#   python hcc_service.py --port 8765        (or --unix /run/hcc.sock)
+
+class RequestError(ValueError):
+  pass
+
+def diagnosis(value):
+  if isinstance(value, str):
+    code, codetype = value, 0
+  elif isinstance(value, dict):
+    code, codetype = value["code"], value.get("type", 0)
+  else:
+    code, codetype = value
+  if not isinstance(code, str):
+    raise RequestError("diagnosis code %r is not a string" % (code,))
+  return hcc.normalize_icd(code), ICDType(int(codetype))
+
+# a JSON boolean, or 0/1; "false" must not read as true
+def flag(member, name):
+  value = member.get(name, False)
+  if isinstance(value, bool) or (type(value) is int and value in (0, 1)):
+    return bool(value)
+  raise RequestError("%s must be true, false, 0 or 1, not %r" % (name, value))
+
+# the MemberStoreBuilder.append arguments of a JSON member, validated here so
+# a bad member fails its own request rather than the batch it joins
+def member_args(member):
+  try:
+    sex = hcc_io.sexes.get(str(member["sex"]).upper())
+    if sex is None:
+      raise RequestError("unknown sex %r" % member["sex"])
+    dob = str(member["dob"]).replace("-","")
+    hcc.parse_dob(dob)
+    return (str(member["hicno"]), sex, dob,
+            EntitlementReason(int(member.get("orec", 0))),
+            flag(member, "medicaid"), flag(member, "nemcaid"),
+            [diagnosis(d) for d in member.get("diagnoses", [])])
+  except RequestError:
+    raise
+  except (KeyError, TypeError, ValueError) as e:
+    raise RequestError("invalid member %s: %s" % (member.get("hicno") if isinstance(member, dict) else member, e))
+
+class Metrics:
+  def __init__(self, window=10000):
+    self.started = time.time()
+    self.requests = 0
+    self.errors = 0
+    self.members = 0
+    self.batches = 0
+    self.batch_members = 0
+    self.batch_seconds = 0.0
+    self.latencies = deque(maxlen=window)  # seconds, most recent requests
+
+  def observe_request(self, seconds, members):
+    self.requests += 1
+    self.members += members
+    self.latencies.append(seconds)
+
+  def observe_batch(self, members, seconds):
+    self.batches += 1
+    self.batch_members += members
+    self.batch_seconds += seconds
+
+  def snapshot(self):
+    uptime = time.time() - self.started
+    latencies = list(self.latencies)
+    return {"uptime_s": uptime,
+            "requests": self.requests,
+            "errors": self.errors,
+            "members": self.members,
+            "members_per_sec": self.members / uptime if uptime else 0.0,
+            "batches": self.batches,
+            "mean_batch_size": self.batch_members / self.batches if self.batches else 0.0,
+            "batch_seconds": self.batch_seconds,
+            "latency_p50_ms": percentile(latencies, 50) * 1000,
+            "latency_p99_ms": percentile(latencies, 99) * 1000}
+
+  def prometheus(self, prefix="hcc_service"):
+    s = self.snapshot()
+    lines = []
+    def metric(name, kind, help, value, labels=""):
+      lines.append("# HELP %s_%s %s" % (prefix, name, help))
+      lines.append("# TYPE %s_%s %s" % (prefix, name, kind))
+      lines.append("%s_%s%s %r" % (prefix, name, labels, value))
+    metric("requests_total", "counter", "Scoring requests answered.", s["requests"])
+    metric("errors_total", "counter", "Requests rejected or failed.", s["errors"])
+    metric("members_total", "counter", "Members scored.", s["members"])
+    metric("batches_total", "counter", "Batches passed to the batch engine.", s["batches"])
+    metric("batch_members_total", "counter", "Members in those batches.", self.batch_members)
+    metric("batch_seconds_total", "counter", "Time spent scoring batches.", s["batch_seconds"])
+    lines.append("# HELP %s_latency_seconds Request latency over the last %d requests." % (prefix, self.latencies.maxlen))
+    lines.append("# TYPE %s_latency_seconds summary" % prefix)
+    for q in (50, 99):
+      lines.append('%s_latency_seconds{quantile="0.%d"} %r' % (prefix, q, percentile(list(self.latencies), q)))
+    lines.append("%s_latency_seconds_count %d" % (prefix, len(self.latencies)))
+    return "\n".join(lines) + "\n"
+
+class Batcher:
+  def __init__(self, metrics, max_batch=256, max_delay=0.002):
+    self.metrics = metrics
+    self.max_batch = max_batch
+    self.max_delay = max_delay
+    self.queue = asyncio.Queue()
+
+  # members are member_args tuples; returns one score dict per member
+  async def score(self, members, as_of=None, version=None):
+    future = asyncio.get_running_loop().create_future()
+    await self.queue.put((members, as_of, version, future))
+    return await future
+
+  async def run(self):
+    loop = asyncio.get_running_loop()
+    while True:
+      items = [await self.queue.get()]
+      # let requests that are already parsed join; an idle service scores a
+      # lone request at once rather than waiting out max_delay
+      await asyncio.sleep(0)
+      while not self.queue.empty():
+        items.append(self.queue.get_nowait())
+      size = sum(len(item[0]) for item in items)
+      deadline = loop.time() + (self.max_delay if len(items) > 1 else 0)
+      while size < self.max_batch:
+        timeout = deadline - loop.time()
+        if timeout <= 0:
+          break
+        try:
+          item = await asyncio.wait_for(self.queue.get(), timeout)
+        except asyncio.TimeoutError:
+          break
+        items.append(item)
+        size += len(item[0])
+      self.flush(items)
+
+  # one score_store call per (as_of, version) among the queued requests.  If
+  # a group fails, its requests are scored one by one, so the error reaches
+  # only the request that caused it.
+  def flush(self, items):
+    groups = {}
+    for item in items:
+      groups.setdefault((item[1], item[2]), []).append(item)
+    for (as_of, version), group in groups.items():
+      try:
+        self.score_group(group, as_of, version)
+      except Exception:
+        for item in group:
+          try:
+            self.score_group([item], as_of, version)
+          except Exception as e:
+            if not item[3].done():
+              item[3].set_exception(e)
+
+  def score_group(self, group, as_of, version):
+    start = time.perf_counter()
+    builder = hcc_store.MemberStoreBuilder()
+    for members, _, _, _ in group:
+      for args in members:
+        builder.append(*args)
+    result = hcc_batch.score_store(builder.build(), hcc_batch.batch_tables(version), as_of)
+    row = 0
+    for members, _, _, future in group:
+      scores = [dict([("hicno", result.hicnos[i])] +
+                     [(m, float(result.scores[m][i])) for m in hcc_batch.models])
+                for i in range(row, row + len(members))]
+      row += len(members)
+      if not future.done():
+        future.set_result(scores)
+    self.metrics.observe_batch(row, time.perf_counter() - start)
+
+class Service:
+  def __init__(self, max_batch=256, max_delay=0.002):
+    self.metrics = Metrics()
+    self.batcher = Batcher(self.metrics, max_batch, max_delay)
+    self.writers = {}  # open connections -> their handler tasks
+
+  def warm(self, versions=(None,)):
+    for version in versions:
+      hcc_batch.batch_tables(version)
+
+  async def handle_score(self, body):
+    try:
+      request = json.loads(body or b"{}")
+    except ValueError as e:
+      raise RequestError("invalid JSON: %s" % e)
+    if not isinstance(request, dict) or ("member" in request) == ("members" in request):
+      raise RequestError('expected {"member": {...}} or {"members": [...]}')
+    single = "member" in request
+    members = [request["member"]] if single else request["members"]
+    if not isinstance(members, list):
+      raise RequestError('"members" must be a list')
+    as_of = None
+    if request.get("as_of"):
+      try:
+        as_of = datetime.strptime(request["as_of"], "%Y-%m-%d")
+      except (TypeError, ValueError):
+        raise RequestError("as_of must be YYYY-MM-DD")
+    version = request.get("version")
+    if version is not None:
+      try:
+        hcc_batch.batch_tables(version)
+      except KeyError as e:
+        raise RequestError(e.args[0])
+    args = [member_args(m) for m in members]
+    scores = await self.batcher.score(args, as_of, version) if args else []
+    return {"score": scores[0]} if single else {"scores": scores}
+
+  async def respond(self, method, path, body):
+    route, _, query = path.partition("?")
+    if route == "/score" and method == "POST":
+      start = time.perf_counter()
+      try:
+        out = await self.handle_score(body)
+      except RequestError as e:
+        self.metrics.errors += 1
+        return 400, "application/json", json.dumps({"error": str(e)})
+      self.metrics.observe_request(time.perf_counter() - start,
+                                   len(out["scores"]) if "scores" in out else 1)
+      return 200, "application/json", json.dumps(out)
+    if route == "/metrics" and method == "GET":
+      if "format=json" in query:
+        return 200, "application/json", json.dumps(self.metrics.snapshot())
+      return 200, "text/plain; version=0.0.4", self.metrics.prometheus()
+    if route == "/health" and method == "GET":
+      return 200, "application/json", json.dumps({"status": "ok"})
+    return 404, "application/json", json.dumps({"error": "no route %s %s" % (method, route)})
+
+  # HTTP/1.1 with keep-alive; requests carry a Content-Length body
+  async def connection(self, reader, writer):
+    self.writers[writer] = asyncio.current_task()
+    try:
+      while True:
+        line = await reader.readline()
+        if not line:
+          break
+        try:
+          method, path, version = line.decode("latin1").split()
+        except ValueError:
+          break
+        headers = {}
+        while True:
+          header = await reader.readline()
+          if header in (b"\r\n", b"\n", b""):
+            break
+          name, _, value = header.decode("latin1").partition(":")
+          headers[name.strip().lower()] = value.strip()
+        body = await reader.readexactly(int(headers.get("content-length", 0) or 0))
+        try:
+          status, content_type, payload = await self.respond(method, path, body)
+        except Exception as e:
+          self.metrics.errors += 1
+          status, content_type, payload = 500, "application/json", json.dumps({"error": str(e)})
+        data = payload.encode("utf-8")
+        close = headers.get("connection", "").lower() == "close" or version == "HTTP/1.0"
+        writer.write(("HTTP/1.1 %d %s\r\nContent-Type: %s\r\nContent-Length: %d\r\n%s\r\n" % (
+          status, {200: "OK", 400: "Bad Request", 404: "Not Found"}.get(status, "Error"),
+          content_type, len(data), "Connection: close\r\n" if close else "")).encode("latin1") + data)
+        await writer.drain()
+        if close:
+          break
+    except (asyncio.IncompleteReadError, ConnectionError):
+      pass
+    finally:
+      self.writers.pop(writer, None)
+      writer.close()
+
+  async def start(self, host="127.0.0.1", port=8765, unix=None):
+    self.warm()
+    self.batch_task = asyncio.ensure_future(self.batcher.run())
+    if unix:
+      self.server = await asyncio.start_unix_server(self.connection, path=unix)
+    else:
+      self.server = await asyncio.start_server(self.connection, host, port)
+    return self.server
+
+  async def stop(self):
+    self.server.close()
+    tasks = list(self.writers.values())
+    for writer in list(self.writers):
+      writer.close()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    await self.server.wait_closed()
+    self.batch_task.cancel()
+
+async def serve(host="127.0.0.1", port=8765, unix=None, max_batch=256, max_delay=0.002):
+  service = Service(max_batch, max_delay)
+  server = await service.start(host, port, unix)
+  async with server:
+    await server.serve_forever()
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description="Serve HCC scores over HTTP/JSON.")
+  parser.add_argument("--host", default="127.0.0.1")
+  parser.add_argument("--port", type=int, default=8765)
+  parser.add_argument("--unix", help="listen on this Unix socket instead of TCP")
+  parser.add_argument("--max-batch", type=int, default=256,
+                      help="members scored together at most, unless one request is larger")
+  parser.add_argument("--max-delay-ms", type=float, default=2.0,
+                      help="how long a request waits for others to batch with")
+  args = parser.parse_args(argv)
+  asyncio.run(serve(args.host, args.port, args.unix, args.max_batch, args.max_delay_ms / 1000.0))
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,175 @@
+from array import array
+from datetime import datetime
+import numpy as np
+import hcc
+import hcc_io
+from hcc import EntitlementReason
+
+# Columnar member store.  A population is a handful of parallel arrays
+# instead of a Beneficiary per member and a Diagnosis per code:
+#   hicnos     list of member ids
+#   sex        uint8  1 male, 2 female
+#   dob        int32  YYYYMMDD
+#   orec       uint8  EntitlementReason
+#   medicaid   bool
+#   nemcaid    bool
+#   offsets    int64  CSR offsets: member i's diagnoses are
+#              diagnoses[offsets[i]:offsets[i+1]]
+#   diagnoses  int32  ids into codes, the interned (icd,type) keys
+# The batch engine scores a store directly (hcc_batch.score_store), and
+# hcc_io/hcc_columnar/hcc_parallel stream their input files through it.
+
+sex_codes = {"male":1, "female":2}
+
+class Codes:
+  def __init__(self):
+    self.keys = []    # id -> (icd, type)
+    self.index = {}   # (icd, type) -> id
+
+  def intern(self, key):
+    id = self.index.get(key)
+    if id is None:
+      id = self.index[key] = len(self.keys)
+      self.keys.append(key)
+    return id
+
+  def __len__(self):
+    return len(self.keys)
+
+class MemberStore:
+  def __init__(self, hicnos, sex, dob, orec, medicaid, nemcaid, offsets, diagnoses, codes):
+    self.hicnos = hicnos
+    self.sex = sex
+    self.dob = dob
+    self.orec = orec
+    self.medicaid = medicaid
+    self.nemcaid = nemcaid
+    self.offsets = offsets
+    self.diagnoses = diagnoses
+    self.codes = codes
+
+  def __len__(self):
+    return len(self.hicnos)
+
+  def __repr__(self):
+    return "MemberStore(members=%d, diagnoses=%d, codes=%d)" % (
+      len(self), len(self.diagnoses), len(self.codes))
+
+  # age in whole years on as_of (today by default), as hcc.age_as_of
+  def ages(self, as_of=None):
+    as_of = as_of or datetime.now()
+    year, monthday = self.dob // 10000, self.dob % 10000
+    return (as_of.year - year - (as_of.month * 100 + as_of.day < monthday)).astype(np.int64)
+
+  # the member row of every diagnosis
+  def diagnosis_members(self):
+    return np.repeat(np.arange(len(self), dtype=np.intp), np.diff(self.offsets))
+
+  def keys_of(self, i):
+    return [self.codes.keys[c] for c in self.diagnoses[self.offsets[i]:self.offsets[i + 1]]]
+
+  # members start:stop, sharing the code table
+  def slice(self, start, stop):
+    lo, hi = self.offsets[start], self.offsets[stop]
+    return MemberStore(self.hicnos[start:stop], self.sex[start:stop], self.dob[start:stop],
+                       self.orec[start:stop], self.medicaid[start:stop], self.nemcaid[start:stop],
+                       self.offsets[start:stop + 1] - lo, self.diagnoses[lo:hi], self.codes)
+
+  # the members at rows, in that order, sharing the code table
+  def take(self, rows):
+    rows = np.asarray(rows, dtype=np.intp)
+    starts = self.offsets[rows]
+    counts = self.offsets[rows + 1] - starts
+    offsets = np.concatenate(([0], np.cumsum(counts))).astype(np.int64)
+    within = np.arange(offsets[-1]) - np.repeat(offsets[:-1], counts)
+    return MemberStore([self.hicnos[i] for i in rows.tolist()], self.sex[rows], self.dob[rows],
+                       self.orec[rows], self.medicaid[rows], self.nemcaid[rows], offsets,
+                       self.diagnoses[np.repeat(starts, counts) + within], self.codes)
+
+  def chunks(self, size):
+    for start in range(0, len(self), size):
+      yield self.slice(start, min(start + size, len(self)))
+
+  def nbytes(self):
+    return sum(a.nbytes for a in (self.sex, self.dob, self.orec, self.medicaid,
+                                  self.nemcaid, self.offsets, self.diagnoses))
+
+class MemberStoreBuilder:
+  def __init__(self, codes=None):
+    self.codes = codes or Codes()
+    self.hicnos = []
+    self.sex = array("B")
+    self.dob = array("i")
+    self.orec = array("B")
+    self.medicaid = array("B")
+    self.nemcaid = array("B")
+    self.offsets = array("q", [0])
+    self.diagnoses = array("i")
+
+  def __len__(self):
+    return len(self.hicnos)
+
+  # sex is "male"/"female", dob a YYYYMMDD string and diagnoses (icd,type)
+  # keys, normalized as Diagnosis does
+  def append(self, hicno, sex, dob, orec=EntitlementReason.OASI, medicaid=False,
+             nemcaid=False, diagnoses=()):
+    if sex not in sex_codes:
+      raise ValueError("unknown sex %r for %s" % (sex, hicno))
+    born = hcc.parse_dob(dob)
+    self.hicnos.append(hicno)
+    self.sex.append(sex_codes[sex])
+    self.dob.append(born.year * 10000 + born.month * 100 + born.day)
+    self.orec.append(int(orec))
+    self.medicaid.append(medicaid == True)
+    self.nemcaid.append(nemcaid == True)
+    intern = self.codes.intern
+    normalize = hcc.normalize_icd
+    self.diagnoses.extend(intern((normalize(icd), int(codetype))) for icd, codetype in diagnoses)
+    self.offsets.append(len(self.diagnoses))
+
+  def append_beneficiary(self, b):
+    self.append(b.hicno, b.sex, b.dob.strftime("%Y%m%d"), b.original_reason_entitlement,
+                b.medicaid, b.newenrollee_medicaid,
+                [(diag.icdcode, diag.codetype) for diag in b.diagnoses])
+
+  # a person row and its diagnosis rows, as hcc_io.read_members yields them
+  def append_rows(self, row, diagnoses, idvar="HICNO"):
+    self.append(*hcc_io.person_fields(row, idvar),
+                diagnoses=[(diag["DIAG"], hcc_io.diagnosis_type(diag)) for diag in diagnoses])
+
+  def build(self):
+    return MemberStore(self.hicnos,
+                       np.frombuffer(self.sex, dtype=np.uint8).copy(),
+                       np.frombuffer(self.dob, dtype=np.int32).copy(),
+                       np.frombuffer(self.orec, dtype=np.uint8).copy(),
+                       np.frombuffer(self.medicaid, dtype=np.uint8).astype(bool),
+                       np.frombuffer(self.nemcaid, dtype=np.uint8).astype(bool),
+                       np.frombuffer(self.offsets, dtype=np.int64).copy(),
+                       np.frombuffer(self.diagnoses, dtype=np.int32).copy(),
+                       self.codes)
+
+def from_beneficiaries(beneficiaries):
+  builder = MemberStoreBuilder()
+  for b in beneficiaries:
+    builder.append_beneficiary(b)
+  return builder.build()
+
+# the person and diagnosis files as one store, without building Beneficiary
+# objects
+def read_files(person_path, diag_path, idvar="HICNO", key=str, delimiter=","):
+  builder = MemberStoreBuilder()
+  for row, diagnoses in hcc_io.read_members(person_path, diag_path, idvar, key, delimiter):
+    builder.append_rows(row, diagnoses, idvar)
+  return builder.build()
+
+# the same, a store of chunk_size members at a time; each chunk has its own
+# code table, so it can be shipped to a worker on its own
+def read_chunks(person_path, diag_path, chunk_size=10000, idvar="HICNO", key=str, delimiter=","):
+  builder = MemberStoreBuilder()
+  for row, diagnoses in hcc_io.read_members(person_path, diag_path, idvar, key, delimiter):
+    builder.append_rows(row, diagnoses, idvar)
+    if len(builder) >= chunk_size:
+      yield builder.build()
+      builder = MemberStoreBuilder()
+  if len(builder):
+    yield builder.build()
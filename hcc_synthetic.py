@@ -0,0 +1,118 @@
+import csv
+import random
+import hcc_engine
+import hcc_io
+from hcc import Diagnosis, EntitlementReason, ICDType, payment_year_as_of
+
+# Synthetic Medicare populations drawn from the real code tables, for
+# benchmarks and parity runs.  Like the generators in AlgorexCore.py the
+# shapes are simple random variates: ages pile up just past 65 and decay
+# exponentially, disabled members are spread over working ages, and the
+# number of diagnoses per member is exponential (most members have a few,
+# a long tail has dozens).  Codes are skewed towards the front of a
+# shuffled code list so some are common and most are rare, with a share of
+# codes that map to no CC at all, as in real claims.
+#
+# A member is (person, diagnoses): person is a row of the SAS person file
+# (HICNO, DOB, SEX, OREC, MCAID, NEMCAID) and diagnoses a list of
+# (icd, type) keys, type 0 for ICD10 and 9 for ICD9.
+
+orecs = [(EntitlementReason.OASI,0.75), (EntitlementReason.DIB,0.22),
+         (EntitlementReason.ESRD,0.01), (EntitlementReason.DIB_AND_ESRD,0.02)]
+
+# frequent outpatient codes that do not map to an HCC
+unmapped = [("Z0000",0), ("Z23",0), ("I10",0), ("E785",0), ("R05",0),
+            ("M545",0), ("Z1231",0), ("J069",0), ("V700",9), ("4019",9)]
+
+class Generator:
+  def __init__(self, seed=0, as_of=None, mean_diagnoses=6.0, icd9_share=0.05,
+               unmapped_share=0.1, t=None):
+    t = t or hcc_engine.tables()
+    self.random = random.Random(seed)
+    self.as_of = as_of or payment_year_as_of(2017)
+    self.mean_diagnoses = mean_diagnoses
+    self.icd9_share = icd9_share
+    self.unmapped_share = unmapped_share
+    self.icd10 = sorted(k for k in t.cc if k[1] == 0)
+    self.icd9 = sorted(k for k in t.cc if k[1] == 9)
+    self.random.shuffle(self.icd10)
+    self.random.shuffle(self.icd9)
+
+  def orec(self):
+    r = self.random.random()
+    for orec, p in orecs:
+      if r < p:
+        return orec
+      r -= p
+    return EntitlementReason.OASI
+
+  def age(self, orec):
+    r = self.random
+    if orec == EntitlementReason.OASI or (orec == EntitlementReason.DIB and r.random() < 0.3):
+      return min(65 + int(r.expovariate(1/10.0)), 105)
+    if orec == EntitlementReason.DIB:
+      return r.randint(21, 64)
+    return r.randint(20, 90)
+
+  def dob(self, age):
+    month, day = self.random.randint(1,12), self.random.randint(1,28)
+    year = self.as_of.year - age - ((self.as_of.month, self.as_of.day) < (month, day))
+    return "%04d%02d%02d" % (year, month, day)
+
+  def code(self):
+    r = self.random
+    if r.random() < self.unmapped_share:
+      return r.choice(unmapped)
+    codes = self.icd9 if r.random() < self.icd9_share else self.icd10
+    return codes[int(len(codes) * r.random() ** 3)]
+
+  def member(self, hicno):
+    r = self.random
+    orec = self.orec()
+    person = {"HICNO": "%09d" % hicno,
+              "DOB": self.dob(self.age(orec)),
+              "SEX": "2" if r.random() < 0.55 else "1",
+              "OREC": str(int(orec)),
+              "MCAID": "1" if r.random() < 0.2 else "0",
+              "NEMCAID": "1" if r.random() < 0.1 else "0"}
+    count = min(int(r.expovariate(1/self.mean_diagnoses)), 40)
+    return person, [self.code() for _ in range(count)]
+
+  def members(self, n, start=1):
+    for hicno in range(start, start + n):
+      yield self.member(hicno)
+
+def population(n, seed=0, as_of=None, **kwargs):
+  return Generator(seed, as_of, **kwargs).members(n)
+
+# the hcc_batch.member_record tuple of a synthetic member, without building
+# a Beneficiary
+def member_record(member, as_of=None):
+  person, diagnoses = member
+  as_of = as_of or payment_year_as_of(2017)
+  dob = person["DOB"]
+  year, month, day = int(dob[:4]), int(dob[4:6]), int(dob[6:])
+  age = as_of.year - year - ((as_of.month, as_of.day) < (month, day))
+  return (person["HICNO"], int(person["SEX"]), age, int(person["OREC"]),
+          person["MCAID"] == "1", tuple(diagnoses))
+
+def beneficiary(member, as_of=None):
+  person, diagnoses = member
+  b = hcc_io.person_beneficiary(person, as_of=as_of or payment_year_as_of(2017))
+  for icd, codetype in diagnoses:
+    b.add_diagnosis(Diagnosis(b, icd, ICDType(codetype)))
+  return b
+
+def write_files(members, person_path, diag_path, delimiter=","):
+  count = 0
+  with open(person_path, "w", newline='') as pf, open(diag_path, "w", newline='') as df:
+    people = csv.writer(pf, delimiter=delimiter)
+    diags = csv.writer(df, delimiter=delimiter)
+    people.writerow(["HICNO", "DOB", "SEX", "OREC", "MCAID", "NEMCAID"])
+    diags.writerow(["HICNO", "DIAG", "DIAG_TYPE"])
+    for person, diagnoses in members:
+      people.writerow([person[c] for c in ("HICNO", "DOB", "SEX", "OREC", "MCAID", "NEMCAID")])
+      for icd, codetype in diagnoses:
+        diags.writerow([person["HICNO"], icd, codetype])
+      count += 1
+  return count
@@ -0,0 +1,144 @@
+import hashlib
+import os
+import struct
+from array import array
+import hcc
+
+# The parsed cc, coefficient and overrides tables, and a versioned binary
+# cache of them.  The cache is a flat file of named sections (an interned
+# string table, uint32 index pairs and float64 coefficients), read back with
+# array.frombytes instead of pickle.  Its name carries a digest of the
+# source files and the hierarchy, so editing icd10.txt, icd9.txt,
+# coefficients.txt or hcc.hierarchy() makes a new cache rather than reusing
+# a stale one.
+
+FORMAT_VERSION = 1
+MAGIC = b"HCCT"
+coefficient_file = "coefficients.txt"
+
+def cache_dir():
+  return os.environ.get("HCC_CACHE_DIR",
+                        os.path.join(os.path.expanduser("~"), ".cache", "hcc-python"))
+
+# the text tables a model version is parsed from; None means the tables
+# bundled with hcc.py
+def sources(code_tables=None, coefficients=None, hierarchy=None):
+  return (list(code_tables if code_tables is not None else hcc.code_tables()),
+          coefficients or coefficient_file,
+          list(hierarchy if hierarchy is not None else hcc.hierarchy()))
+
+def source_files(code_tables=None, coefficients=None):
+  code_tables, coefficients, _ = sources(code_tables, coefficients, ())
+  return [f for f,_ in code_tables] + [coefficients]
+
+def tables_version(code_tables=None, coefficients=None, hierarchy=None):
+  code_tables, coefficients, hierarchy = sources(code_tables, coefficients, hierarchy)
+  digest = hashlib.sha256(b"%d" % FORMAT_VERSION)
+  dir = os.path.dirname(hcc.__file__)
+  for f in source_files(code_tables, coefficients):
+    with open(os.path.join(dir,f), 'rb') as file:
+      digest.update(f.encode() + b"\0" + file.read())
+  digest.update(repr(hierarchy).encode())
+  return digest.hexdigest()
+
+class ParsedTables:
+  def __init__(self, cc, coefficients, overrides, version):
+    self.cc = cc                      # icd type -> [(icd, cc)]
+    self.coefficients = coefficients  # [(label, coefficient)]
+    self.overrides = overrides        # [(overrider, overridee)]
+    self.version = version
+
+def parse_tables(version=None, code_tables=None, coefficients=None, hierarchy=None):
+  code_tables, coefficients, hierarchy = sources(code_tables, coefficients, hierarchy)
+  cc = {icdcodetype: list(hcc.read_cc_file(f)) for f,icdcodetype in code_tables}
+  overrides = [(o,c) for o, overridees in hierarchy for c in overridees]
+  return ParsedTables(cc, list(hcc.read_coefficients(coefficients)), overrides,
+                      version or tables_version(code_tables, coefficients, hierarchy))
+
+def _intern(strings, index, s):
+  if s not in index:
+    index[s] = len(strings)
+    strings.append(s)
+  return index[s]
+
+def _pairs(strings, index, pairs):
+  return array("I", [_intern(strings, index, s) for pair in pairs for s in pair])
+
+def write_cache(parsed, path):
+  strings, index = [], {}
+  sections = []
+  for icdcodetype, pairs in sorted(parsed.cc.items()):
+    sections.append(("cc.%d" % icdcodetype, _pairs(strings, index, pairs).tobytes()))
+  sections.append(("overrides", _pairs(strings, index, parsed.overrides).tobytes()))
+  labels = array("I", [_intern(strings, index, label) for label,_ in parsed.coefficients])
+  sections.append(("coef.labels", labels.tobytes()))
+  sections.append(("coef.values", array("d", [c for _,c in parsed.coefficients]).tobytes()))
+  sections.insert(0, ("strings", "\n".join(strings).encode("utf-8")))
+
+  tmp = path + ".%d.tmp" % os.getpid()
+  with open(tmp, 'wb') as file:
+    file.write(MAGIC + struct.pack("<I32sI", FORMAT_VERSION, bytes.fromhex(parsed.version), len(sections)))
+    for name, payload in sections:
+      file.write(struct.pack("<16sQ", name.encode(), len(payload)))
+      file.write(payload)
+  os.replace(tmp, path)
+
+def read_cache(path, version):
+  with open(path, 'rb') as file:
+    data = file.read()
+  magic, (fmt, digest, nsections) = data[:4], struct.unpack_from("<I32sI", data, 4)
+  if magic != MAGIC or fmt != FORMAT_VERSION or digest.hex() != version:
+    return None
+  offset = 4 + struct.calcsize("<I32sI")
+  sections = {}
+  for _ in range(nsections):
+    name, length = struct.unpack_from("<16sQ", data, offset)
+    offset += struct.calcsize("<16sQ")
+    sections[name.rstrip(b"\0").decode()] = data[offset:offset + length]
+    offset += length
+
+  strings = sections.pop("strings").decode("utf-8").split("\n")
+  def ints(name):
+    out = array("I")
+    out.frombytes(sections.pop(name))
+    return out
+  def pairs(name):
+    ids = ints(name)
+    return [(strings[a], strings[b]) for a, b in zip(ids[::2], ids[1::2])]
+  values = array("d")
+  values.frombytes(sections.pop("coef.values"))
+  coefficients = list(zip([strings[i] for i in ints("coef.labels")], values))
+  overrides = pairs("overrides")
+  cc = {int(name[len("cc."):]): pairs(name) for name in list(sections) if name.startswith("cc.")}
+  return ParsedTables(cc, coefficients, overrides, version)
+
+_parsed = {}
+
+# the parsed tables, from the binary cache when it is current; a cache
+# that cannot be written (read-only home, ...) is simply skipped.  Each set
+# of sources (see sources()) is parsed once per process.
+def parsed_tables(cache=True, code_tables=None, coefficients=None, hierarchy=None):
+  code_tables, coefficients, hierarchy = sources(code_tables, coefficients, hierarchy)
+  key = (tuple(code_tables), coefficients, repr(hierarchy))
+  if key in _parsed:
+    return _parsed[key]
+  version = tables_version(code_tables, coefficients, hierarchy)
+  path = os.path.join(cache_dir(), "tables-%s.bin" % version[:16])
+  parsed = None
+  if cache:
+    try:
+      parsed = read_cache(path, version)
+    # a truncated or corrupt cache (missing sections, string ids out of
+    # range) is reparsed like a missing one
+    except (OSError, ValueError, KeyError, IndexError, struct.error):
+      parsed = None
+  if parsed is None:
+    parsed = parse_tables(version, code_tables, coefficients, hierarchy)
+    if cache:
+      try:
+        os.makedirs(cache_dir(), exist_ok=True)
+        write_cache(parsed, path)
+      except OSError:
+        pass
+  _parsed[key] = parsed
+  return parsed
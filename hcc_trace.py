@@ -0,0 +1,116 @@
+import argparse
+import json
+from datetime import datetime
+import hcc
+import hcc_engine
+import hcc_store
+from hcc_engine import bits, demographic_indicators, mask_indicators
+
+# Audit trail of a member's score.  trace() scores a member the way the
+# compiled engine does (hcc_engine.score_store) and records, as it goes:
+#   diagnoses     [icd, type, rule, ccs] per distinct diagnosis, where rule is
+#                 "cc", "sex_edit", "age_edit" (both edits: "sex_edit+age_edit"),
+#                 "excised" or "unmapped"
+#   dropped       [cc, overriding cc] for every cc an overrides entry removed
+#   hccs          the hierarchical ccs
+#   interactions  [indicator, left hccs, right hccs] for the interactions that
+#                 fired; the disabled interactions with their hcc
+#   models        {model: {"score": s, "terms": [[variable, coefficient], ...]}}
+# The lineage comes out of the same mask operations as the score, with no
+# second pass, and the scores equal hcc_engine's.  Traces export as JSON
+# lines:
+#
+#   python hcc_trace.py person.csv diag.csv traces.jsonl --year 2016
+
+def trace(hicno, keys, sex, age, orec, medicaid, t=None):
+  t = t or hcc_engine.tables()
+  female, under18 = sex == "female", age < 18
+  diagnoses = []
+  m = 0
+  for key in sorted(keys):
+    if under18 and key in t.age_excisions:
+      diagnoses.append([key[0], key[1], "excised", []])
+      continue
+    rule = []
+    edits = 0
+    if female and key in t.sex_edit_masks:
+      edits |= t.sex_edit_masks[key]
+      rule.append("sex_edit")
+    if under18 and key in t.age_edit_masks:
+      edits |= t.age_edit_masks[key]
+      rule.append("age_edit")
+    mapped = edits or t.cc_masks.get(key, 0)
+    if not edits:
+      rule = ["cc" if mapped else "unmapped"]
+    diagnoses.append([key[0], key[1], "+".join(rule), t.ccs_of(mapped)])
+    m |= mapped
+
+  dropped = []
+  suppressed = 0
+  for i in bits(m):
+    suppressed |= t.suppress[i]
+    for j in bits(t.suppress[i] & m):
+      dropped.append([t.bit_ccs[j], t.bit_ccs[i]])
+  h = m & ~suppressed
+
+  dis = hcc.is_disabled(age, orec)
+  interactions = [[name, t.ccs_of(h & left), t.ccs_of(h & right)]
+                  for name, left, right in t.interaction_masks if h & left and h & right]
+  if dis:
+    interactions += [[name, t.ccs_of(bit), []] for name, bit in t.disabled_masks if h & bit]
+  ind = demographic_indicators(sex, age, orec, medicaid) | mask_indicators(h, dis, t)
+
+  models = {}
+  for model, (reg_vars, _) in t.models.items():
+    coefficients = t.model_coefficients[model]
+    terms = [[var, coefficients[var]] for var in sorted(ind & reg_vars) if var in coefficients]
+    models[model] = {"score": sum(c for _, c in terms), "terms": terms}
+  return {"hicno": hicno, "sex": sex, "age": age, "orec": int(orec), "medicaid": medicaid == True,
+          "diagnoses": diagnoses, "dropped": dropped, "hccs": t.ccs_of(h),
+          "interactions": interactions, "models": models}
+
+def trace_beneficiary(b, t=None):
+  return trace(b.hicno, hcc_engine.diagnosis_keys(b), b.sex, b.age,
+               b.original_reason_entitlement, b.medicaid, t)
+
+# a trace for every member of an hcc_store.MemberStore, ages taken on as_of
+def trace_store(store, t=None, as_of=None):
+  t = t or hcc_engine.tables()
+  keys = store.codes.keys
+  offsets = store.offsets.tolist()
+  diagnoses = store.diagnoses.tolist()
+  rows = zip(store.hicnos, store.sex.tolist(), store.ages(as_of).tolist(),
+             store.orec.tolist(), store.medicaid.tolist())
+  for i, (hicno, sex, age, orec, medicaid) in enumerate(rows):
+    yield trace(hicno, frozenset(keys[c] for c in diagnoses[offsets[i]:offsets[i+1]]),
+                "male" if sex == 1 else "female", age, orec, medicaid, t)
+
+# trace every member of the person file to a JSON lines file, a chunk of
+# members at a time
+def trace_files(person_path, diag_path, out_path, chunk_size=10000, idvar="HICNO", key=str,
+                delimiter=",", as_of=None, version=None):
+  t = hcc_engine.tables(version)
+  count = 0
+  with open(out_path, "w") as out:
+    for store in hcc_store.read_chunks(person_path, diag_path, chunk_size, idvar, key, delimiter):
+      for record in trace_store(store, t, as_of):
+        out.write(json.dumps(record, separators=(",", ":")) + "\n")
+      count += len(store)
+  return count
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description="Write the audit trail of every member's HCC score as JSON lines.")
+  parser.add_argument("person")
+  parser.add_argument("diag")
+  parser.add_argument("out")
+  parser.add_argument("--year", type=int, help="payment year; ages are taken on February 1 of it")
+  parser.add_argument("--version", help="registered model version (default V21)")
+  parser.add_argument("--chunk-size", type=int, default=10000)
+  args = parser.parse_args(argv)
+  as_of = hcc.payment_year_as_of(args.year) if args.year else None
+  start = datetime.now()
+  count = trace_files(args.person, args.diag, args.out, args.chunk_size, as_of=as_of, version=args.version)
+  print("traced %d members in %s" % (count, datetime.now() - start))
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,23 @@
+import hcc_results
+
+def rows(cache):
+  return cache.db.execute("SELECT COUNT(*) FROM results").fetchone()[0]
+
+def entries(start, n):
+  return [(("member-%d" % i).encode().ljust(16, b"-"), (1.0, 2.0, float(i))) for i in range(start, start + n)]
+
+def test_max_bytes_holds_after_put(tmp_path):
+  with hcc_results.ResultCache(str(tmp_path / "r.sqlite"), max_bytes=100000) as cache:
+    for chunk in range(6):
+      cache.put(entries(chunk * 2000, 2000))
+      assert cache.nbytes() <= 100000
+      assert len(cache) == rows(cache) > 0
+
+def test_replaced_entries_are_counted_once(tmp_path):
+  path = str(tmp_path / "r.sqlite")
+  with hcc_results.ResultCache(path) as cache:
+    cache.put(entries(0, 100))
+    cache.put(entries(50, 100))
+    assert len(cache) == rows(cache) == 150
+  with hcc_results.ResultCache(path, max_entries=120) as cache:
+    assert len(cache) == rows(cache) == 120
@@ -0,0 +1,61 @@
+import asyncio
+import json
+import hcc_service
+from hcc import ICDType
+
+good = {"hicno": "1", "sex": "female", "dob": "19480415", "orec": 0,
+        "medicaid": False, "diagnoses": ["E119", ["2860", 9]]}
+
+async def post(port, body):
+  reader, writer = await asyncio.open_connection("127.0.0.1", port)
+  data = json.dumps(body).encode()
+  writer.write(b"POST /score HTTP/1.1\r\nContent-Length: %d\r\nConnection: close\r\n\r\n" % len(data) + data)
+  await writer.drain()
+  status = int((await reader.readline()).split()[1])
+  payload = (await reader.read()).split(b"\r\n\r\n", 1)[1]
+  writer.close()
+  return status, json.loads(payload)
+
+async def concurrent(bodies, max_delay=0.05):
+  service = hcc_service.Service(max_delay=max_delay)
+  server = await service.start("127.0.0.1", 0)
+  port = server.sockets[0].getsockname()[1]
+  try:
+    return await asyncio.gather(*[post(port, body) for body in bodies])
+  finally:
+    await service.stop()
+
+def test_bad_request_does_not_fail_the_batch():
+  bad = dict(good, hicno="2", diagnoses=[[4019, 9]])
+  (s1, r1), (s2, r2), (s3, r3) = asyncio.run(concurrent([{"member": good}, {"member": bad}, {"member": good}]))
+  assert (s1, s2, s3) == (200, 400, 200)
+  assert r1 == r3 and r1["score"]["hicno"] == "1"
+  assert "not a string" in r2["error"]
+
+def test_failing_member_in_flush_fails_only_its_request():
+  async def run():
+    batcher = hcc_service.Batcher(hcc_service.Metrics(), max_delay=0.05)
+    task = asyncio.ensure_future(batcher.run())
+    args = hcc_service.member_args(good)
+    broken = args[:6] + ([(4019, ICDType.NINE)],)
+    try:
+      return await asyncio.gather(batcher.score([args]), batcher.score([broken]), batcher.score([args]),
+                                  return_exceptions=True)
+    finally:
+      task.cancel()
+  first, second, third = asyncio.run(run())
+  assert isinstance(second, Exception)
+  assert first == third and first[0]["hicno"] == "1"
+
+def test_flags():
+  assert hcc_service.member_args(dict(good, medicaid=1))[4] is True
+  assert hcc_service.member_args(dict(good, medicaid=False))[4] is False
+  for value in ("false", "0", 2, None):
+    try:
+      hcc_service.member_args(dict(good, medicaid=value))
+    except hcc_service.RequestError:
+      continue
+    raise AssertionError("medicaid %r accepted" % (value,))
+
+def test_codes_normalized():
+  assert hcc_service.member_args(dict(good, diagnoses=["e11.9 "]))[6] == [("E119", ICDType.TEN)]